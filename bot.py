@@ -1,14 +1,29 @@
-from PIL import Image, ImageEnhance
 import telebot
 import os
+import threading
 import time
 import traceback
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from keyboa import keyboa_maker
-from visage import ApplyMakeup
+from visage import ApplyMakeup, BufferPool, LandmarkCache
 #from visage import flag
 
-makeup = ApplyMakeup()
+#лица ищутся один раз на фото: при загрузке и при повторных /go с тем же фото
+#кадры рендера переиспользуются между заказами, чтобы память бота не скакала
+makeup = ApplyMakeup(cache=LandmarkCache(), buffer_pool=BufferPool())
+
+#очередь обработки: фото рендерятся в пуле потоков, бот тем временем отвечает остальным
+RENDER_WORKERS = os.cpu_count() or 2
+MAX_QUEUE = 4 * RENDER_WORKERS
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+queue_lock = threading.Lock()
+queued_jobs = 0
+#задания одного чата выполняются по порядку: следующее уходит в пул,
+#когда закончится предыдущее, и не занимает поток, пока ждёт
+#чат есть в chat_queues, пока у него выполняется задание
+chat_queues = {}
 
 #чтение из файла ( для фоток)
 def read_file(file_name):
@@ -134,31 +149,31 @@ def callback_handler(call):
         user[chat_id]['blush_color'] = { 'r': 162, 'g': 59 , 'b': 108 }
         user[chat_id]['use_blush'] = True    
         bot.edit_message_text('Цвет румян: лиловый', chat_id, call.message.id)
-        processing(chat_id)
+        enqueue(chat_id)
     
     elif call.data == 'blush_r250_g218_b221':
         user[chat_id]['blush_color'] = { 'r': 250, 'g': 218 , 'b': 221 }
         user[chat_id]['use_blush'] = True    
         bot.edit_message_text('Цвет румян: розовый', chat_id, call.message.id)
-        processing(chat_id)
+        enqueue(chat_id)
         
     elif call.data == 'blush_r205_g92_b92':
         user[chat_id]['blush_color'] = { 'r': 205, 'g': 92 , 'b': 92 }
         user[chat_id]['use_blush'] = True    
         bot.edit_message_text('Цвет румян: красный', chat_id, call.message.id)
-        processing(chat_id)
+        enqueue(chat_id)
         
     elif call.data == 'blush_r150_g75_b0':
         user[chat_id]['blush_color'] = { 'r': 150, 'g': 75 , 'b': 0 }
         user[chat_id]['use_blush'] = True    
         bot.edit_message_text('Цвет румян: коричневый', chat_id, call.message.id)
-        processing(chat_id)
+        enqueue(chat_id)
 
     elif call.data == 'blush_off':
         user[chat_id]['blush_color'] = None
         user[chat_id]['use_blush'] = False   
         bot.edit_message_text('Без румян', chat_id, call.message.id)
-        processing(chat_id)
+        enqueue(chat_id)
 
     elif call.data == 'add_photo':
         bot.edit_message_text('Фото получено. Отправьте ещё фото', chat_id, call.message.id)
@@ -189,8 +204,8 @@ def start(message):
         )
         bot.send_message(
             message.from_user.id, 
-            'Бот обрабатывает фотографии последовательно по 2 за раз. Если ответ на фото не поступил, '
-            + 'вы находитесь в очереди на обработку. Необходимо подождать.\n' 
+            'Бот обрабатывает несколько заявок одновременно. Если все обработчики заняты, '
+            + 'бот сообщит ваше место в очереди. Необходимо подождать.\n' 
             + 'Если обнаружились проблемы или есть предложения по улучшению, напишите автору в разделе /author.'
         )
     elif message.text == '/help':
@@ -209,7 +224,6 @@ def start(message):
     elif message.text == '/go':
         user[message.chat.id] = {
             'source_images': [],
-            'result_images': [],
             'photo_messages': [],
             'use_lipstick': False,
             'use_liner': False,
@@ -234,19 +248,20 @@ def handle_docs_photo(message):
 
     try:
         file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        src = '/home/ekaterina/visage/' + file_info.file_path
+        #фото хранится в памяти, на диск ничего не пишется
+        src = bot.download_file(file_info.file_path)
         
         processing_info_message = bot.send_message(
             chat_id,
             "Обработка фото..."
         )
         
-        with open(src, 'wb') as new_file:
-           new_file.write(downloaded_file)
-        
-        if check_photo(src) is False:
+        #быстрая проверка только отвечает, есть ли лицо; сами лица ищутся заново при обработке
+        has_face = makeup.has_face(src, 'NETWORK_BYTE_STREAM') is not None
+        if not has_face:
+            #на уменьшенной копии мелкие лица (групповые фото) теряются, ищем ещё раз в полном размере
+            has_face = makeup.has_face(src, 'NETWORK_BYTE_STREAM', fast=False) is not None
+        if not has_face:
             bot.delete_message(chat_id, processing_info_message.id)
             actions_with_ids = []        
             if len(user[chat_id]['source_images']) > 0:
@@ -359,77 +374,89 @@ def choose_liner(chat_id):
         text = 'Нужна подводка?'
     )
     
-def processing(chat_id):
+#постановка заявки в очередь
+def enqueue(chat_id):
+    global queued_jobs
+    with queue_lock:
+        full = queued_jobs >= MAX_QUEUE
+        if not full:
+            queued_jobs += 1
+            position = queued_jobs - RENDER_WORKERS
+    if full:
+        bot.send_message(chat_id, 'Сейчас очень много заявок, попробуйте через пару минут ещё раз')
+        choose_blush(chat_id)
+        return
+    #настройки забираются из user, чтобы новый /go не мешал уже поставленной заявке
+    options = user.pop(chat_id)
+    if position > 0:
+        bot.send_message(chat_id, 'Вы в очереди на обработку, место в очереди: %d' % position)
+    with queue_lock:
+        waiting = chat_queues.get(chat_id)
+        if waiting is not None:
+            waiting.append(options)
+            return
+        chat_queues[chat_id] = deque()
+    render_pool.submit(run_job, chat_id, options)
+
+def run_job(chat_id, options):
+    global queued_jobs
+    try:
+        processing(chat_id, options)
+    except Exception as e:
+        traceback.print_exc()
+    finally:
+        with queue_lock:
+            queued_jobs -= 1
+            waiting = chat_queues[chat_id]
+            if waiting:
+                options = waiting.popleft()
+            else:
+                del chat_queues[chat_id]
+                options = None
+        #следующее задание этого чата
+        if options is not None:
+            render_pool.submit(run_job, chat_id, options)
+
+def processing(chat_id, options):
     bot.send_message(chat_id, 'Обработка фотографий... Это может занять какое то время')
     
-    for i in range(len(user[chat_id]['source_images'])):
+    for i in range(len(options['source_images'])):
         try:
-            list_points = makeup.get_face_data(user[chat_id]['source_images'][i], 'FILE_READ')
-            result_src = photo_processing(user[chat_id]['source_images'][i], user[chat_id], list_points)
-            user[chat_id]['result_images'].append(result_src)
-            photo = open(result_src, 'rb')
-            bot.send_photo(chat_id, photo)
+            #прямоугольники с миниатюры при загрузке не годятся: на ней не видно мелких лиц,
+            #поэтому лица ищутся в полном размере (повторные /go с тем же фото берутся из кэша)
+            list_points = makeup.get_face_data(
+                options['source_images'][i], 'NETWORK_BYTE_STREAM', all_faces=True
+            )
+            result = photo_processing(options['source_images'][i], options, list_points)
+            bot.send_photo(chat_id, result)
         except Exception as e:
             traceback.print_exc()
-            bot.reply_to(user[chat_id]['photo_messages'][i], 'Не удалось обработать эту фотографию(')
+            bot.reply_to(options['photo_messages'][i], 'Не удалось обработать эту фотографию(')
     bot.send_message(
         chat_id,
         'Все фото обработаны, вы так прекрасны 🥰. Напишите /go что бы обработать ещё фото',
     )
-    clear_content(chat_id)
-    
-def check_photo(image_path):
-    photo = Image.open(image_path)
-    #photo = open(image_path, 'rb')
-    list_points = makeup.get_face_data(image_path, 'FILE_READ') 
-    return list_points is not None
     
+def rgb(option):
+    return option['r'], option['g'], option['b']
+
 #обработка фото
-def photo_processing(image_path, options, list_points):
-    result_src = image_path
+def photo_processing(image_bytes, options, list_points):
     start_time = time.time()
-    if options['use_lipstick']:
-        result_src = makeup.apply_lipstick(
-            result_src,
-            list_points,
-            options['lipstick_color']['r'],
-            options['lipstick_color']['g'],
-            options['lipstick_color']['b'],
-        )
-    if options['use_liner']:
-        result_src = makeup.apply_liner(result_src, list_points)
-    if options['use_blush']:
-        result_src = makeup.apply_blush(
-            result_src,
-            list_points,
-            options['blush_color']['r'],
-            options['blush_color']['g'],
-            options['blush_color']['b'],
-        )
-    if options['use_eyeshadow']:
-        result_src = makeup.apply_eyeshadow(
-            result_src,
-            list_points,
-            options['eyeshadow_color']['r'],
-            options['eyeshadow_color']['g'],
-            options['eyeshadow_color']['b'],
-        )
+    result = makeup.apply_look(
+        image_bytes,
+        list_points,
+        lipstick=rgb(options['lipstick_color']) if options['use_lipstick'] else None,
+        liner=options['use_liner'],
+        blush=rgb(options['blush_color']) if options['use_blush'] else None,
+        eyeshadow=rgb(options['eyeshadow_color']) if options['use_eyeshadow'] else None,
+        flag='NETWORK_BYTE_STREAM',
+        output_flag='NETWORK_BYTE_STREAM',
+    )
     print("Фото обработано за:")
     print("--- %s seconds ---" % (time.time() - start_time))
     
-    return result_src
-
-#очищение папки с фото
-def clear_content(chat_id):
-    try:
-        for img in user[chat_id]['source_images']:
-            os.remove(img)
-        for img in user[chat_id]['result_images']:
-            os.remove(img)
-    except Exception as e:
-        time.sleep(3)
-        clear_content(chat_id)
-    del user[chat_id]
+    return result
 
 
 #проверка наличия новых сообщений
@@ -19,6 +19,12 @@ setup(
         'dlib'
     ],
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'visage-batch=visage.batch:main',
+            'visage-video=visage.video:main',
+        ],
+    },
     keywords='image processing virtual makeup face detection opencv',
     classifiers=[],
 )
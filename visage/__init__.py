@@ -3,5 +3,27 @@ Created on Mon Sep 04 13:01:31 2017
 @author: Hriddhi Dey
 """
 
-from visage.detect_features import DetectLandmarks
-from visage.apply_makeup import ApplyMakeup
+# Public names are imported on first access, so that `import visage` and the
+# command line tools start without loading OpenCV, scipy or dlib up front.
+_EXPORTS = {
+    'DetectLandmarks': 'visage.detect_features',
+    'LandmarkCache': 'visage.detect_features',
+    'preload': 'visage.detect_features',
+    'ApplyMakeup': 'visage.apply_makeup',
+    'BufferPool': 'visage.apply_makeup',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module 'visage' has no attribute %r" % (name,))
+    import importlib
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
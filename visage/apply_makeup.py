@@ -6,28 +6,104 @@ Created on Mon Mar 20 12:28:21 2017
 
 This module contains the ApplyMakeup class.
 """
-from scipy import interpolate
-from pylab import *
-import itertools
-import scipy.interpolate
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 import cv2
 import numpy as np
-import os.path
-import sys
-from urllib.request import urlretrieve
-import dlib
-import numpy
-from skimage import color
-
-PREDICTOR_PATH = "shape_predictor_68_face_landmarks.dat"
-CASC_PATH = "haarcascade_frontalface_default.xml"
+from visage import detect_features
+# scipy.interpolate and skimage.color are imported where they are used, so
+# that importing visage does not pay for them until the first render.
+
 BLUSH_INTENSIVITY = 0.3
 EYESHADOWN_INTENSIVITY = 0.2
 LIPS_INTENSIVITY = 0.3
 
-class DetectLandmarks(object):
+# Landmark indexes of the closed polygons around the right and left cheek.
+BLUSH_REGIONS = np.array([[48, 0, 1, 2, 31, 48], [54, 13, 14, 15, 35, 54]])
+# Landmark indexes of the closed polygons between the right and left brow and eye.
+EYESHADOW_REGIONS = np.array([
+    [17, 18, 19, 20, 39, 38, 37, 36, 17], [26, 25, 24, 23, 22, 42, 43, 44, 26]
+])
+# The brow side of each eyeshadow polygon is pulled towards these points of the eye side.
+EYESHADOW_TARGETS = [8, 8, 7, 6, 5]
+EYESHADOW_FORCE = 0.3
+LINER_COLOR = (0, 0, 0)
+MASK_REUSE_SHIFT = 1.0
+MASK_WARP_RESIDUAL = 2.0
+# Feather kernels, as fractions of the distance between the eye centres.
+# On a face whose eyes are REFERENCE_EYE_DISTANCE pixels apart they are
+# the 101, 201 and 71 pixel blurs and 12 pixel erosion tuned originally.
+REFERENCE_EYE_DISTANCE = 200.0
+LIPS_FEATHER = 101 / REFERENCE_EYE_DISTANCE
+BLUSH_FEATHER = 201 / REFERENCE_EYE_DISTANCE
+EYESHADOW_FEATHER = 71 / REFERENCE_EYE_DISTANCE
+EYESHADOW_ERODE = 12 / REFERENCE_EYE_DISTANCE
+# Masks are blurred shrunk so that the kernel spans at most this many pixels.
+FEATHER_MAX_KERNEL = 31
+BUFFER_POOL_BYTES = 256 * 1024 * 1024
+# Sampling density of the splines drawn around blush and eyeshadow regions.
+BOUNDARY_SAMPLES_PER_PIXEL = 1.5
+BOUNDARY_MIN_SAMPLES = 32
+
+def feather_size(fraction, eye_distance=None):
+    """ Returns the odd kernel size, in pixels, of a fraction of the eye distance. """
+    if eye_distance is None:
+        eye_distance = REFERENCE_EYE_DISTANCE
+    return int(round(fraction * eye_distance / 2.0)) * 2 + 1
+
+
+def feather(mask, ksize, erode=0):
+    """
+    Returns mask blurred by a ksize Gaussian, then eroded by an erode pixel square.
+
+    Large kernels are applied on a copy of mask shrunk by a whole factor so
+    that the kernel spans at most FEATHER_MAX_KERNEL pixels, and the result
+    is scaled back up. The Gaussian is smooth enough that this looks the
+    same, and the cost no longer grows with the kernel.
+    """
+    factor = max(1, ksize // FEATHER_MAX_KERNEL)
+    height, width = mask.shape[:2]
+    if factor > 1:
+        size = (-(-width // factor), -(-height // factor))
+        mask = cv2.resize(mask, size, interpolation=cv2.INTER_AREA)
+        ksize = int(ksize / factor) // 2 * 2 + 1
+        erode = int(round(erode / float(factor)))
+    mask = cv2.GaussianBlur(mask, (ksize, ksize), 0)
+    if erode > 1:
+        mask = cv2.erode(mask, np.ones((erode, erode), np.uint8), iterations=1)
+    if factor > 1:
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+    return mask
+
+
+def blend(background, source, alpha, out=None):
+    """
+    Returns source laid over background, as uint8.
+
+    alpha is a single-channel mask of the weight of source, broadcast over
+    the colour channels instead of being copied into each of them. 8-bit
+    sources are blended by cv2.blendLinear in one pass. Float sources, such
+    as the skimage Lab conversion returns, use one float32 buffer. The
+    result is written to out if given.
     """
-    This is the class responsible for landmark detection on a human face.
+    alpha = np.asarray(alpha, dtype=np.float32)
+    if source.dtype == np.uint8:
+        return cv2.blendLinear(source, background, alpha, 1 - alpha, dst=out)
+    result = np.subtract(source, background, dtype=np.float32)
+    np.multiply(result, alpha[..., None], out=result)
+    np.add(result, background, out=result)
+    if out is None:
+        return result.astype(np.uint8)
+    np.copyto(out, result, casting='unsafe')
+    return out
+
+
+class DetectLandmarks(detect_features.DetectLandmarks):
+    """
+    Landmark detection extended with the facial regions used for makeup.
+    Face detection itself is inherited from visage.detect_features.
 
     Functions available for use:
         1. get_face_data: Returns all detected landmarks for a face.
@@ -35,99 +111,6 @@ class DetectLandmarks(object):
         3. get_upper_eyelids: Returns points of eyeliner for a face.
     """
 
-    IMAGE_DATA = 'IMAGE_DATA'
-    FILE_READ = 'FILE_READ'
-    NETWORK_BYTE_STREAM = 'NETWORK_BYTE_STREAM'
-
-
-
-    def __init__(self):
-        """ Initiator for DetectLandmarks class.
-        Downloads the predictor file if not available.
-        Raises:
-            `Exception`, if download of predictor fails.
-        """
-        if not os.path.isfile(PREDICTOR_PATH):
-            try:
-                print ('Predictor not found. Downloading...this may take a while...')
-                url = 'https://github.com/hriddhidey/visage/blob/master/visage/shape_predictor_68_face_landmarks.dat?raw=true'
-                def dl_progress(count, block_size, total_size):
-                    """ Show download progress bar. """
-                    percent = int(count*block_size*100/total_size)
-                    sys.stdout.write("\r" + 'Progress:' + "...%d%%" % percent)
-                    sys.stdout.flush()
-                urlretrieve(
-                    url,
-                    PREDICTOR_PATH,
-                    reporthook=dl_progress
-                )
-                print ('Predictor downloaded.')
-            except IOError:
-                print ('Download failed. Try again with reliable network connection.')
-                raise IOError
-        self.predictor = dlib.shape_predictor(PREDICTOR_PATH)
-        self.cascade = cv2.CascadeClassifier(CASC_PATH)
-        self.detector = dlib.get_frontal_face_detector()
-
-
-
-    def __get_landmarks(self, image):
-        """ Extract the landmarks from a given image. 
-        Returns `None` if no landmarks found.
-        """
-        try:
-            rects = self.detector(image, 1)
-            size = len(rects)
-            if size == 0:
-                return None, None
-            return numpy.matrix([[p.x, p.y] for p in self.predictor(image, rects[0]).parts()])
-        except Exception:
-            return None
-
-
-
-    def get_face_data(self, image_file, flag):
-        """
-        Returns all facial landmarks in a given image.
-        ______________________________________________
-        Args:
-            1. `image_file`:
-                Either of three options:\n
-                    a. (int) Image data after being read with cv2.imread()\n
-                    b. File path of locally stored image file.\n
-                    c. Byte stream being received over multipart network request.\n\n
-            2. `flag`:
-                Used to denote the type of image_file parameter being passed.
-                Possible values are IMG_DATA, FILE_READ, NETWORK_BYTE_STREAM respectively.
-                By default its value is IMAGE_DATA, and assumes imread() image is passed.
-
-        Returns:
-            String with list of detected points of face.
-
-        Error:
-            Returns `None` if face not found in image.
-
-        """
-        start_time = time.time()
-        image = 0
-        if flag == self.FILE_READ:
-            image = cv2.imread(image_file)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        elif flag == self.NETWORK_BYTE_STREAM:
-            image = cv2.imdecode(
-                numpy.fromstring(image_file.read(), numpy.uint8), cv2.IMREAD_UNCHANGED
-            )
-        elif flag == self.IMAGE_DATA or flag is None:
-            image = image_file
-        landmarks = self.__get_landmarks(image)
-        if landmarks[0] is None or landmarks[1] is None:
-            return None
-        print("Фото:")
-        print("--- %s seconds ---" % (time.time() - start_time))
-        return landmarks
-
-
-
     def get_lips(self, image_file, list_points, flag=None):
         """
         Returns points for lips in given image.
@@ -150,13 +133,16 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        landmarks = list_points
-        if landmarks is None:
+        lips = self.get_lips_points(list_points)
+        if lips is None:
             return None
-        lips = ""
-        for point in landmarks[48:]:
-            lips += str(point).replace('[', '').replace(']', '') + '\n'
-        return lips
+        return detect_features.format_points(lips)
+
+    def get_lips_points(self, list_points):
+        """ Returns the 20x2 array of lip points from get_face_data() landmarks. """
+        if list_points is None:
+            return None
+        return detect_features.as_landmarks(list_points)[detect_features.LIPS]
 
     def get_blushs_right(self, image_file, list_points, flag=None):
         """
@@ -180,37 +166,10 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        
-        landmarks = list_points
-        if landmarks is None:
+        if list_points is None:
             return None
-        blushs = []
-        for point in landmarks[48]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[0:3]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[31]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[48]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        
-        xc = 0
-        yc = 0
-        
-        for point in blushs:
-            xc += point[0]
-            yc += point[1]
-        
-        xc = xc / len(blushs)
-        yc = yc / len(blushs)
-        
-        for point in blushs:
-            point[0] = (xc + point[0]) * 0.5
-            point[1] = (yc + point[1]) * 0.5
-        
-        blushs = np.asmatrix(blushs)
-        
-        return np.asarray(blushs[0:6, 1]).reshape(-1), np.asarray(blushs[0:6, 0]).reshape(-1)
+        blushs = self.get_makeup_regions(list_points)[0][0]
+        return blushs[:, 1], blushs[:, 0]
 
     def get_blushs_left(self, image_file, list_points, flag=None):
         """
@@ -234,41 +193,44 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        landmarks = list_points
-        if landmarks is None:
+        if list_points is None:
             return None
-        blushs = []
-        for point in landmarks[54]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[13:16]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[35]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-        for point in landmarks[54]:
-            blushs = [*blushs, np.asarray(point).reshape(-1)]
-            
-        xc = 0
-        yc = 0
-        
-        for point in blushs:
-            xc += point[0]
-            yc += point[1]
-        
-        xc = xc / len(blushs)
-        yc = yc / len(blushs)
-        
-        for point in blushs:
-            point[0] = (xc + point[0]) * 0.5
-            point[1] = (yc + point[1]) * 0.5
-              
-        blushs = np.asmatrix(blushs)
-            
-        return np.asarray(blushs[0:6, 1]).reshape(-1), np.asarray(blushs[0:6, 0]).reshape(-1)
+        blushs = self.get_makeup_regions(list_points)[0][1]
+        return blushs[:, 1], blushs[:, 0]
         
         
     def offsetPoint(self, point, target, force):      
         point[0] = target[0] * force + point[0] * (1 - force)
         point[1] = target[1] * force + point[1] * (1 - force)
+
+    def get_makeup_regions(self, list_points):
+        """
+        Returns the closed polygons for blush and eyeshadow, for both sides of the face.
+        ________________________________________________________________________________
+        Args:
+            1. `list_points`: Landmarks returned by get_face_data().
+
+        Returns:
+            `(blushs, eyeshadows)`, int32 arrays of shape (2, 6, 2) and (2, 9, 2)
+            holding (x, y) polygon points for the right and left side.
+
+        """
+        landmarks = detect_features.as_landmarks(list_points)
+
+        blushs = landmarks[BLUSH_REGIONS]
+        centroids = blushs.mean(axis=1, keepdims=True)
+        blushs = ((centroids + blushs) * 0.5).astype(np.int32)
+        # The closing mouth corner shares its point with the first one, and
+        # has always been pulled towards the centroid twice.
+        blushs[:, 0] = blushs[:, -1] = (centroids[:, 0] + blushs[:, 0]) * 0.5
+
+        eyeshadows = landmarks[EYESHADOW_REGIONS]
+        eyeshadows[:, :5] = (
+            eyeshadows[:, EYESHADOW_TARGETS] * EYESHADOW_FORCE
+            + eyeshadows[:, :5] * (1 - EYESHADOW_FORCE)
+        )
+        eyeshadows[:, -1] = eyeshadows[:, 0]
+        return blushs, eyeshadows
         
     def get_eyeshadows_right(self, image_file, list_points, flag=None):
         """
@@ -292,35 +254,11 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        
-        landmarks = list_points
-        if landmarks is None:
+        if list_points is None:
             return None
-        eyeshadows = []
-        for point in landmarks[17:21]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[39]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[38]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[37]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[36]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[17]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]      
-                  
-            
-        self.offsetPoint(eyeshadows[0], eyeshadows[8], 0.3)
-        self.offsetPoint(eyeshadows[1], eyeshadows[8], 0.3)
-        self.offsetPoint(eyeshadows[2], eyeshadows[7], 0.3)
-        self.offsetPoint(eyeshadows[3], eyeshadows[6], 0.3)
-        self.offsetPoint(eyeshadows[4], eyeshadows[5], 0.3)
-        self.offsetPoint(eyeshadows[8], eyeshadows[8], 0.3)
-
-        eyeshadows = np.asmatrix(eyeshadows)
-        
-        return np.asarray(eyeshadows[0:9, 1]).reshape(-1), np.asarray(eyeshadows[0:9, 0]).reshape(-1)
+        eyeshadows = self.get_makeup_regions(list_points)[1][0]
+        return eyeshadows[:, 1], eyeshadows[:, 0]
+
 
     def get_eyeshadows_left(self, image_file, list_points, flag=None):
         """
@@ -344,36 +282,12 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        landmarks = list_points
-        if landmarks is None:
+        if list_points is None:
             return None
-        eyeshadows = []
-        for point in landmarks[26]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[25]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[24]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[23]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[22]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[42:45]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-        for point in landmarks[26]:
-            eyeshadows = [*eyeshadows, np.asarray(point).reshape(-1)]
-
-        self.offsetPoint(eyeshadows[0], eyeshadows[8], 0.3)
-        self.offsetPoint(eyeshadows[1], eyeshadows[8], 0.3)
-        self.offsetPoint(eyeshadows[2], eyeshadows[7], 0.3)
-        self.offsetPoint(eyeshadows[3], eyeshadows[6], 0.3)
-        self.offsetPoint(eyeshadows[4], eyeshadows[5], 0.3)
-        self.offsetPoint(eyeshadows[8], eyeshadows[8], 0.3)
-
-        eyeshadows = np.asmatrix(eyeshadows)
-            
-        return np.asarray(eyeshadows[0:9, 1]).reshape(-1), np.asarray(eyeshadows[0:9, 0]).reshape(-1)
-        
+        eyeshadows = self.get_makeup_regions(list_points)[1][1]
+        return eyeshadows[:, 1], eyeshadows[:, 0]
+
+
     def get_upper_eyelids(self, image_file, list_points, flag=None):
         """
         Returns points for upper eyelids in given image.
@@ -396,154 +310,388 @@ class DetectLandmarks(object):
             Returns `None` if face not found in image.
 
         """
-        landmarks = list_points
-        if landmarks is None:
+        eyelids = self.get_upper_eyelids_points(list_points)
+        if eyelids is None:
+            return None
+        return '\n'.join(detect_features.format_points(eyelid) for eyelid in eyelids)
+
+    def get_upper_eyelids_points(self, list_points):
+        """ Returns the two 4x2 arrays of upper eyelid points from get_face_data() landmarks. """
+        if list_points is None:
+            return None
+        landmarks = detect_features.as_landmarks(list_points)
+        return (
+            landmarks[detect_features.RIGHT_UPPER_EYELID],
+            landmarks[detect_features.LEFT_UPPER_EYELID]
+        )
+
+
+class MaskCache(object):
+    """
+    Feather masks of earlier renders, reused while the face barely moves.
+
+    Every mask is stored with the anchor points it was built from, e.g. the
+    landmarks of its region. While the anchors move at most `reuse_shift`
+    pixels, the mask is reused as it is. While they follow a similarity
+    transform to within `warp_residual` pixels, the stored mask is warped
+    with it. Otherwise it is rebuilt. Meant for consecutive video frames.
+    Not safe to share between threads.
+    """
+
+    def __init__(self, reuse_shift=MASK_REUSE_SHIFT, warp_residual=MASK_WARP_RESIDUAL):
+        self.reuse_shift = reuse_shift
+        self.warp_residual = warp_residual
+        self.__entries = {}
+
+    def clear(self):
+        """ Forgets every stored mask. """
+        self.__entries.clear()
+
+    def get(self, key, anchor, build, height, width):
+        """ Returns `(rows, cols, mask)` of key, calling build() if it must be rebuilt.
+        Returns `None`, and stores nothing, when build() does, i.e. when the
+        region lies outside the image.
+        """
+        anchor = np.asarray(anchor, dtype=np.float32).reshape(-1, 2)
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0].shape == anchor.shape:
+            if np.abs(anchor - entry[0]).max() <= self.reuse_shift:
+                return entry[1:]
+            warped = self.__warp(entry, anchor, height, width)
+            if warped is not None:
+                return warped
+        built = build()
+        if built is None:
+            self.__entries.pop(key, None)
+            return None
+        # Warps always start from the built mask, so errors do not add up.
+        self.__entries[key] = (anchor,) + built
+        return built
+
+    def __warp(self, entry, anchor, height, width):
+        """ Warps a stored mask onto anchor, or returns `None` if the motion is not rigid. """
+        old_anchor, rows, cols, mask = entry
+        transform = cv2.estimateAffinePartial2D(old_anchor, anchor)[0]
+        if transform is None:
+            return None
+        moved = cv2.transform(old_anchor.reshape(-1, 1, 2), transform).reshape(-1, 2)
+        if np.abs(moved - anchor).max() > self.warp_residual:
+            return None
+        corners = np.float32([
+            [cols.start, rows.start], [cols.stop, rows.start],
+            [cols.start, rows.stop], [cols.stop, rows.stop]
+        ])
+        corners = cv2.transform(corners.reshape(-1, 1, 2), transform).reshape(-1, 2)
+        x_min, y_min = np.floor(corners.min(axis=0)).astype(int)
+        x_max, y_max = np.ceil(corners.max(axis=0)).astype(int)
+        new_rows = slice(max(y_min, 0), min(y_max, height))
+        new_cols = slice(max(x_min, 0), min(x_max, width))
+        if new_rows.stop <= new_rows.start or new_cols.stop <= new_cols.start:
             return None
-        liner = ""
-        for point in landmarks[36:40]:
-            liner += str(point).replace('[', '').replace(']', '') + '\n'
-        liner += '\n'
-        for point in landmarks[42:46]:
-            liner += str(point).replace('[', '').replace(']', '') + '\n'
-        return liner
+        # Map the local coordinates of the old region onto the new one.
+        transform[:, 2] += transform[:, :2].dot((cols.start, rows.start)) - (new_cols.start, new_rows.start)
+        warped = cv2.warpAffine(
+            mask, transform, (new_cols.stop - new_cols.start, new_rows.stop - new_rows.start),
+            flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+        return new_rows, new_cols, warped
+
+
+class BufferPool(object):
+    """
+    Scratch arrays kept for reuse by later renders.
+
+    Arrays are looked up by shape and dtype. The pool holds at most
+    `max_bytes` of idle arrays and drops the least recently returned ones
+    beyond that, so a long-running process rendering images of similar
+    sizes stops allocating new frames. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes=BUFFER_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__arrays = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def take(self, shape, dtype=np.uint8):
+        """ Returns an array of shape and dtype, with undefined contents. """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.__lock:
+            arrays = self.__arrays.get(key)
+            if arrays:
+                array = arrays.pop()
+                if not arrays:
+                    del self.__arrays[key]
+                self.nbytes -= array.nbytes
+                return array
+        return np.empty(shape, dtype)
+
+    def give(self, *arrays):
+        """ Returns arrays to the pool. The caller must not use them afterwards.
+        Views of other arrays and arrays larger than max_bytes are not kept.
+        """
+        with self.__lock:
+            for array in arrays:
+                if (array is None or array.base is not None or array.nbytes > self.max_bytes
+                        or not array.flags.c_contiguous):
+                    continue
+                key = (array.shape, array.dtype.str)
+                self.__arrays.setdefault(key, []).append(array)
+                self.__arrays.move_to_end(key)
+                self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                key, stale = next(iter(self.__arrays.items()))
+                self.nbytes -= stale.pop(0).nbytes
+                if not stale:
+                    del self.__arrays[key]
+
+    def clear(self):
+        """ Drops every idle array. """
+        with self.__lock:
+            self.__arrays.clear()
+            self.nbytes = 0
+
+
+class MakeupCanvas(object):
+    """
+    Per-render state of ApplyMakeup.
+
+    `image` holds the colours an effect is painted with, and `im_copy` the
+    rendered result the effect is blended into. Every render works on its
+    own canvas, so one ApplyMakeup can be used from several threads.
+    `masks` is an optional MaskCache the feather masks are taken from, and
+    `pool` an optional BufferPool the full-frame arrays are taken from.
+    Region-sized scratch arrays change shape with every face and region,
+    so they are not pooled.
+    """
+
+    def __init__(self, image, masks=None, pool=None):
+        """ Start rendering on an RGB image. """
+        self.pool = pool
+        self.image = image
+        self.im_copy = self.copy(image)
+        self.height, self.width = image.shape[:2]
+        self.masks = masks
+
+    def next_pass(self):
+        """ Start the next effect on top of the result of the previous one. """
+        self.give(self.image)
+        self.image = self.im_copy
+        self.im_copy = self.copy(self.image)
+
+    def copy(self, array):
+        """ Returns a copy of array, from the pool if there is one. """
+        if self.pool is None:
+            return array.copy()
+        result = self.pool.take(array.shape, array.dtype)
+        np.copyto(result, array)
+        return result
+
+    def give(self, *arrays):
+        """ Returns scratch arrays to the pool, if there is one. """
+        if self.pool is not None:
+            self.pool.give(*arrays)
+
+    def blend(self, rows, cols, source, alpha):
+        """ Lays source over im_copy[rows, cols] with the single-channel weight alpha.
+        The region is blended in place.
+        """
+        blend(self.im_copy[rows, cols], source, alpha, self.im_copy[rows, cols])
+
+    def release(self, result=True):
+        """ Returns the arrays of the canvas to the pool once rendering is done.
+        With result=False, im_copy is kept for the caller.
+        """
+        if self.image is not self.im_copy:
+            self.give(self.image)
+        if result:
+            self.give(self.im_copy)
+        self.image = self.im_copy = None
 
 
 class ApplyMakeup(DetectLandmarks):
     """
     Class that handles application of color, and performs blending on image.
+    The landmark predictor is shared, while every render keeps its
+    state in a MakeupCanvas, so instances are safe to use from many threads.
 
     Functions available for use:
         1. apply_lipstick: Applies lipstick on passed image of face.
         2. apply_liner: Applies black eyeliner on passed image of face.
+        3. apply_look: Applies several effects with one decode and encode.
+        4. render: Applies several effects on an RGB array, without any file I/O.
     """
 
-    def __init__(self):
-        """ Initiator method for class """
-        DetectLandmarks.__init__(self)
-        self.red_l = 0
-        self.green_l = 0
-        self.blue_l = 0
-        
-        self.red_e = 0
-        self.green_e = 0
-        self.blue_e = 0
-        
-        self.red_b = 0
-        self.green_b = 0
-        self.blue_b = 0
-        
-        self.debug = 0
-        self.image = 0
-        self.width = 0
-        self.height = 0
-        self.im_copy = 0
-        self.lip_x = []
-        self.lip_y = []
+    LAB_SKIMAGE = 'LAB_SKIMAGE'
+    LAB_OPENCV = 'LAB_OPENCV'
+    FILE_WRITE = 'FILE_WRITE'
+    TEMP_FILE = 'TEMP_FILE'
+
+    def __init__(self, lab_conversion=LAB_SKIMAGE, buffer_pool=None, **kwargs):
+        """ Initiator method for class.
+        Args:
+            1. `lab_conversion`:
+                Colour conversion used to tint blush and eyeshadow.
+                LAB_SKIMAGE converts in float64 with scikit-image (default),
+                LAB_OPENCV uses OpenCV's table-driven 8-bit Lab conversion,
+                which is faster but quantises the tint slightly.
+            2. `buffer_pool`:
+                BufferPool that frames and masks are taken from and returned to,
+                so renders in a long-running process reuse them. Off by default.
+            3. `kwargs`: Detection options forwarded to DetectLandmarks.
+        """
+        DetectLandmarks.__init__(self, **kwargs)
+        self.lab_conversion = lab_conversion
+        self.buffer_pool = buffer_pool
 
 
     def __read_image(self, filename):
         """ Read image from path forwarded """
-        self.image = cv2.imread(filename)
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
-        self.im_copy = self.image.copy()
-        self.height, self.width = self.image.shape[:2]
-        self.debug = 0
+        image = cv2.imread(filename)
+        pool = self.buffer_pool
+        rgb = None if pool is None else pool.take(image.shape, image.dtype)
+        return MakeupCanvas(cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=rgb), pool=pool)
+
+
+    def __decode_input(self, image, flag):
+        """ Returns the RGB image of an apply_* input, as described by flag. """
+        if flag == self.IMAGE_DATA:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if flag == self.NETWORK_BYTE_STREAM:
+            decoded = detect_features.decode_image(detect_features.read_bytes(image))
+            if decoded is None:
+                raise ValueError('Could not decode image bytes')
+            return decoded
+        # Decode without a canvas, whose frames would be taken from the pool for nothing.
+        return cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB)
+
+
+    def __write_output(self, image, file_name, output_flag, output_path=None):
+        """ Returns the rendered RGB image in the form asked for by output_flag.
+        FILE_WRITE (or `None`) encodes it to output_path, or to file_name in the
+        current directory, and returns the path. TEMP_FILE encodes it to a new,
+        uniquely named file in the temporary directory and returns the path.
+        NETWORK_BYTE_STREAM returns the encoded bytes, in the format of the
+        extension of file_name, and IMAGE_DATA returns the BGR array, as
+        cv2.imread() would.
+        """
+        if output_flag == self.IMAGE_DATA:
+            return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        pool = self.buffer_pool
+        bgr = None if pool is None else pool.take(image.shape, image.dtype)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=bgr)
+        try:
+            return self.__encode_output(image, file_name, output_flag, output_path)
+        finally:
+            if pool is not None:
+                pool.give(image)
+
+
+    def __finish(self, canvas, file_name, output_flag, output_path):
+        """ Writes the result of canvas with __write_output, then releases the canvas. """
+        try:
+            return self.__write_output(canvas.im_copy, file_name, output_flag, output_path)
+        finally:
+            canvas.release()
+
+
+    def __encode_output(self, image, file_name, output_flag, output_path):
+        """ Encodes the BGR image as described in __write_output. """
+        if output_flag == self.NETWORK_BYTE_STREAM:
+            return cv2.imencode(os.path.splitext(file_name)[1], image)[1].tobytes()
+        if output_flag == self.TEMP_FILE:
+            stem, extension = os.path.splitext(file_name)
+            handle, file_name = tempfile.mkstemp(prefix=stem + '_', suffix=extension)
+            os.close(handle)
+        elif output_path is not None:
+            file_name = output_path
+        if not cv2.imwrite(file_name, image):
+            raise IOError('Could not write ' + file_name)
+        return file_name
 
 
     def __draw_curve(self, points):
-        """ Draws a curve alone the given points by creating an interpolated path. """
-        x_pts = []
-        y_pts = []
-        curvex = []
-        curvey = []
-        self.debug += 1
-        for point in points:
-            x_pts.append(point[0])
-            y_pts.append(point[1])
-        curve = scipy.interpolate.interp1d(x_pts, y_pts, 'cubic')
-        if self.debug == 1 or self.debug == 2:
-            for i in np.arange(x_pts[0], x_pts[len(x_pts) - 1] + 1, 1):
-                curvex.append(i)
-                curvey.append(int(curve(i)))
+        """ Draws a curve along the given points by creating an interpolated path.
+        The curve is sampled at every integer x between the end points, from left
+        to right. Outlines given from right to left leave out both end columns.
+        """
+        from scipy import interpolate
+        x_pts, y_pts = points[:, 0], points[:, 1]
+        curve = interpolate.interp1d(x_pts, y_pts, 'cubic')
+        if x_pts[0] <= x_pts[-1]:
+            curvex = np.arange(x_pts[0], x_pts[-1] + 1, 1)
         else:
-            for i in np.arange(x_pts[len(x_pts) - 1] + 1, x_pts[0], 1):
-                curvex.append(i)
-                curvey.append(int(curve(i)))
-        return curvex, curvey
-
-
-    def __fill_lip_lines(self, outer, inner):
-        """ Fills the outlines of a lip with colour. """
-        outer_curve = zip(outer[0], outer[1])
-        inner_curve = zip(inner[0], inner[1])
-        count = len(inner[0]) - 1
-        last_inner = [inner[0][count], inner[1][count]]
-        for o_point, i_point in itertools.zip_longest(
-                outer_curve, inner_curve, fillvalue=last_inner
-            ):
-            line = scipy.interpolate.interp1d(
-                [o_point[0], i_point[0]], [o_point[1], i_point[1]], 'linear')
-            xpoints = list(np.arange(o_point[0], i_point[0], 1))
-            self.lip_x.extend(xpoints)
-            self.lip_y.extend([int(point) for point in line(xpoints)])
-        return
+            curvex = np.arange(x_pts[-1] + 1, x_pts[0], 1)
+        return curvex, curve(curvex).astype(int)
+
+
+    def __get_lip_polygon(self, outer, inner):
+        """ Returns the closed polygon between an outer and an inner lip outline. """
+        return np.array(
+            np.r_[np.c_[outer[0], outer[1]], np.c_[inner[0], inner[1]][::-1]], dtype=np.int32
+        )
+
 
+    def __fill_lip_solid(self, canvas, polygon, rgb):
+        """ Fills solid colour inside a lip polygon. """
+        cv2.fillPoly(canvas.image, [polygon], tuple(int(value) for value in rgb))
 
-    def __fill_lip_solid(self, outer, inner):
-        """ Fills solid colour inside two outlines. """
-        inner[0].reverse()
-        inner[1].reverse()
-        outer_curve = zip(outer[0], outer[1])
-        inner_curve = zip(inner[0], inner[1])
-        points = []
-        for point in outer_curve:
-            points.append(np.array(point, dtype=np.int32))
-        for point in inner_curve:
-            points.append(np.array(point, dtype=np.int32))
-        points = np.array(points, dtype=np.int32)
-        self.red_l = int(self.red_l)
-        self.green_l = int(self.green_l)
-        self.blue_l = int(self.blue_l)
-        cv2.fillPoly(self.image, [points], (self.red_l, self.green_l, self.blue_l))
-
-
-    def __smoothen_color(self, outer, inner):
-        """ Smoothens and blends colour applied between a set of outlines. """
-        outer_curve = zip(outer[0], outer[1])
-        inner_curve = zip(inner[0], inner[1])
-        x_points = []
-        y_points = []
-        for point in outer_curve:
-            x_points.append(point[0])
-            y_points.append(point[1])
-        for point in inner_curve:
-            x_points.append(point[0])
-            y_points.append(point[1])
-        img_base = np.zeros((self.height, self.width))
-        cv2.fillConvexPoly(img_base, np.array(np.c_[x_points, y_points], dtype='int32'), 1)
-        img_mask = cv2.GaussianBlur(img_base, (101, 101), 0) #51,51
-        img_blur_3d = np.ndarray([self.height, self.width, 3], dtype='float')
-        img_blur_3d[:, :, 0] = img_mask
-        img_blur_3d[:, :, 1] = img_mask
-        img_blur_3d[:, :, 2] = img_mask
-        self.im_copy = (
-            img_blur_3d * self.image * LIPS_INTENSIVITY + (1 - img_blur_3d * LIPS_INTENSIVITY) * self.im_copy
-        ).astype('uint8')
-
-
-    def __draw_liner(self, eye, kind):
-        """ Draws eyeliner. """
-        eye_x = []
-        eye_y = []
-        x_points = []
-        y_points = []
-        for point in eye:
-            x_points.append(int(point.split()[0]))
-            y_points.append(int(point.split()[1]))
-        curve = scipy.interpolate.interp1d(x_points, y_points, 'quadratic')
-        for point in np.arange(x_points[0], x_points[len(x_points) - 1] + 1, 1):
-            eye_x.append(point)
-            eye_y.append(int(curve(point)))
+
+    def __smoothen_color(self, canvas, points, key=None, anchor=None, eye_distance=None):
+        """ Smoothens and blends colour applied inside a lip polygon. """
+        ksize = feather_size(LIPS_FEATHER, eye_distance)
+        def build(rows, cols):
+            img_base = np.zeros((rows.stop - rows.start, cols.stop - cols.start), np.float32)
+            cv2.fillConvexPoly(img_base, points - (cols.start, rows.start), 1)
+            return feather(img_base, ksize)
+        roi = self.__feather_mask(canvas, points, ksize // 2, build, key, anchor)
+        if roi is None:
+            return
+        rows, cols, img_mask = roi
+        canvas.blend(rows, cols, canvas.image[rows, cols], img_mask * LIPS_INTENSIVITY)
+
+
+    def __feather_mask(self, canvas, points, pad, build, key=None, anchor=None):
+        """ Returns `(rows, cols, mask)`, the feather mask build(rows, cols) of a
+        polygon over its bounding box padded by pad. With a canvas.masks cache
+        and a key, the mask of an earlier frame is reused when anchor allows.
+        Returns `None` if the padded box lies entirely outside the image.
+        """
+        def build_roi():
+            roi = self.__get_roi(canvas, points, pad)
+            if roi is None:
+                return None
+            rows, cols = roi
+            return rows, cols, build(rows, cols)
+        if canvas.masks is None or key is None:
+            return build_roi()
+        return canvas.masks.get(key, anchor, build_roi, canvas.height, canvas.width)
+
+
+    def __get_roi(self, canvas, points, pad):
+        """ Returns row and column slices of the bounding box of points,
+        padded by pad pixels on every side and clipped to the image.
+        Blending only this region is exact as long as pad covers the
+        radius of every filter applied to the mask.
+        Returns `None` if the box lies entirely outside the image.
+        """
+        x_min, y_min = np.min(points, axis=0) - pad - 1
+        x_max, y_max = np.max(points, axis=0) + pad + 2
+        rows = slice(max(int(y_min), 0), min(int(y_max), canvas.height))
+        cols = slice(max(int(x_min), 0), min(int(x_max), canvas.width))
+        if rows.stop <= rows.start or cols.stop <= cols.start:
+            return None
+        return rows, cols
+
+
+    def __draw_liner(self, canvas, eye, kind):
+        """ Draws eyeliner along the (x, y) rows of an upper eyelid. """
+        from scipy import interpolate
+        x_points = eye[:, 0].tolist()
+        y_points = eye[:, 1].tolist()
+        curve = interpolate.interp1d(x_points, y_points, 'quadratic')
+        eye_x = np.arange(x_points[0], x_points[-1] + 1, 1)
+        eye_y = curve(eye_x).astype(int)
         if kind == 'left':
             y_points[0] -= 1
             y_points[1] -= 1
@@ -551,19 +699,6 @@ class ApplyMakeup(DetectLandmarks):
             x_points[0] -= 5
             x_points[1] -= 1
             x_points[2] -= 1
-            curve = scipy.interpolate.interp1d(x_points, y_points, 'quadratic')
-            count = 0
-            for point in np.arange(x_points[len(x_points) - 1], x_points[0], -1):
-                count += 1
-                eye_x.append(point)
-                if count < (len(x_points) / 2):
-                    eye_y.append(int(curve(point)))
-                elif count < (2 * len(x_points) / 3):
-                    eye_y.append(int(curve(point)) - 1)
-                elif count < (4 * len(x_points) / 5):
-                    eye_y.append(int(curve(point)) - 2)
-                else:
-                    eye_y.append(int(curve(point)) - 3)
         elif kind == 'right':
             x_points[3] += 5
             x_points[2] += 1
@@ -571,71 +706,27 @@ class ApplyMakeup(DetectLandmarks):
             y_points[3] -= 1
             y_points[2] -= 1
             y_points[1] -= 1
-            curve = scipy.interpolate.interp1d(x_points, y_points, 'quadratic')
-            count = 0
-            for point in np.arange(x_points[len(x_points) - 1], x_points[0], -1):
-                count += 1
-                eye_x.append(point)
-                if count < (len(x_points) / 2):
-                    eye_y.append(int(curve(point)))
-                elif count < (2 * len(x_points) / 3):
-                    eye_y.append(int(curve(point)) - 1)
-                elif count < (4 * len(x_points) / 5):
-                    eye_y.append(int(curve(point)) - 2)
-                elif count:
-                    eye_y.append(int(curve(point)) - 3)
-        curve = zip(eye_x, eye_y)
-        points = []
-        for point in curve:
-            points.append(np.array(point, dtype=np.int32))
-        points = np.array(points, dtype=np.int32)
-        self.red_e = int(self.red_e)
-        self.green_e = int(self.green_e)
-        self.blue_e = int(self.blue_e)
-        cv2.fillPoly(self.im_copy, [points], (self.red_e, self.green_e, self.blue_e))
+        # The lower edge runs back along the shifted curve, lifted a little more
+        # towards the outer corner so that the liner tapers into a wing.
+        curve = interpolate.interp1d(x_points, y_points, 'quadratic')
+        back_x = np.arange(x_points[-1], x_points[0], -1)
+        count = np.arange(1, len(back_x) + 1)
+        lift = np.select(
+            [count < len(x_points) / 2, count < 2 * len(x_points) / 3, count < 4 * len(x_points) / 5],
+            [0, 1, 2], 3
+        )
+        back_y = curve(back_x).astype(int) - lift
+        points = np.array(np.c_[np.r_[eye_x, back_x], np.r_[eye_y, back_y]], dtype=np.int32)
+        cv2.fillPoly(canvas.im_copy, [points], LINER_COLOR)
         return
 
 
-    def __add_color(self, intensity):
-        print("Add color")
-        """ Adds base colour to all points on lips, at mentioned intensity. """
-        val = color.rgb2lab(
-            (self.image[self.lip_y, self.lip_x] / 255.).reshape(len(self.lip_y), 1, 3)
-        ).reshape(len(self.lip_y), 3)
-        # l_val, a_val, b_val = np.mean(val[:, 0]), np.mean(val[:, 1]), np.mean(val[:, 2])
-        # l1_val, a1_val, b1_val = color.rgb2lab(
-        #     np.array(
-        #         (self.red_l / 255., self.green_l / 255., self.blue_l / 255.)
-        #     ).reshape(1, 1, 3)
-        # ).reshape(3,)
-        # l_final = (l1_val - l_val) * intensity
-        # a_final = (a1_val - a_val) * intensity
-        # b_final = (b1_val - b_val) * intensity
-        
-        # print(l_final)
-        # val[:, 0] = np.clip(val[:, 0] + l_final, 0, 100)
-        # val[:, 1] = np.clip(val[:, 1] + a_final, -127, 128)
-        # val[:, 2] = np.clip(val[:, 2] + b_final, -127, 128)
-        self.image[self.lip_y, self.lip_x] = color.lab2rgb(val.reshape(
-            len(self.lip_y), 1, 3)).reshape(len(self.lip_y), 3) * 255
-
-
     def __get_points_lips(self, lips_points):
-        """ Get the points for the lips. """
-        uol = []
-        uil = []
-        lol = []
-        lil = []
-        for i in range(0, 14, 2):
-            uol.append([int(lips_points[i]), int(lips_points[i + 1])])
-        for i in range(12, 24, 2):
-            lol.append([int(lips_points[i]), int(lips_points[i + 1])])
-        lol.append([int(lips_points[0]), int(lips_points[1])])
-        for i in range(24, 34, 2):
-            uil.append([int(lips_points[i]), int(lips_points[i + 1])])
-        for i in range(32, 40, 2):
-            lil.append([int(lips_points[i]), int(lips_points[i + 1])])
-        lil.append([int(lips_points[24]), int(lips_points[25])])
+        """ Get the upper/lower, outer/inner outlines from the 20 lip points. """
+        uol = lips_points[0:7]
+        lol = np.vstack((lips_points[6:12], lips_points[0]))
+        uil = lips_points[12:17]
+        lil = np.vstack((lips_points[16:20], lips_points[12]))
         return uol, uil, lol, lil
 
 
@@ -647,42 +738,48 @@ class ApplyMakeup(DetectLandmarks):
         lil_curve = self.__draw_curve(lil)
         return uol_curve, uil_curve, lol_curve, lil_curve
 
-    def __get_curves_blushs(self, uol, uil, lol, lil):
-        """ Get the outlines of the lips. """
-        uol_curve = self.__draw_curve(uol)
-        uil_curve = self.__draw_curve(uil)
-        lol_curve = self.__draw_curve(lol)
-        lil_curve = self.__draw_curve(lil)
-        return uol_curve, uil_curve, lol_curve, lil_curve
-
-    def __fill_color(self, uol_c, uil_c, lol_c, lil_c):
+    def __fill_color(self, canvas, rgb, uol_c, uil_c, lol_c, lil_c, key=None, anchor=None,
+                     eye_distance=None):
         """ Fill colour in lips. """
-        self.__fill_lip_lines(uol_c, uil_c)
-        self.__fill_lip_lines(lol_c, lil_c)
-        # self.__add_color(LIPS_INTENSIVITY)
-        self.__fill_lip_solid(uol_c, uil_c)
-        self.__fill_lip_solid(lol_c, lil_c)
-        self.__smoothen_color(uol_c, uil_c)
-        self.__smoothen_color(lol_c, lil_c)
+        upper = self.__get_lip_polygon(uol_c, uil_c)
+        lower = self.__get_lip_polygon(lol_c, lil_c)
+        self.__fill_lip_solid(canvas, upper, rgb)
+        self.__fill_lip_solid(canvas, lower, rgb)
+        self.__smoothen_color(canvas, upper, key and key + ('upper',), anchor, eye_distance)
+        self.__smoothen_color(canvas, lower, key and key + ('lower',), anchor, eye_distance)
 
 
-    def __create_eye_liner(self, eyes_points):
+    def __create_eye_liner(self, canvas, eyes_points):
         """ Apply eyeliner. """
-        left_eye = eyes_points[0].split('\n')
-        right_eye = eyes_points[1].split('\n')
-        right_eye = right_eye[0:4]
-        self.__draw_liner(left_eye, 'left')
-        self.__draw_liner(right_eye, 'right')
+        left_eye, right_eye = eyes_points
+        self.__draw_liner(canvas, left_eye, 'left')
+        self.__draw_liner(canvas, right_eye, 'right')
 
 
     def get_boundary_points(self, x, y):
+        contour = self.get_boundary_contour(x, y)
+        return contour[:, 0], contour[:, 1]
+
+
+    def get_boundary_contour(self, x, y):
+        """ Returns the closed spline through the polygon (x, y) as an
+        ordered Nx2 int32 contour that can be passed to cv2.fillPoly.
+        The spline is sampled about once per pixel of the polygon's
+        perimeter, and every pixel appears only once.
+        """
+        from scipy import interpolate
+        polygon = np.array(np.c_[x, y], dtype=float)
+        perimeter = np.hypot(*(np.roll(polygon, -1, axis=0) - polygon).T).sum()
+        samples = max(int(perimeter * BOUNDARY_SAMPLES_PER_PIXEL), BOUNDARY_MIN_SAMPLES)
         tck, u = interpolate.splprep([x, y], s=0, per=1)
-        unew = np.linspace(u.min(), u.max(), 1000)
+        unew = np.linspace(u.min(), u.max(), samples)
         xnew, ynew = interpolate.splev(unew, tck, der=0)
-        tup = c_[xnew.astype(int), ynew.astype(int)].tolist()
-        coord = list(set(tuple(map(tuple, tup))))
-        coord = np.array([list(elem) for elem in coord])
-        return np.array(coord[:, 0], dtype=np.int32), np.array(coord[:, 1], dtype=np.int32)
+        contour = np.array(np.c_[xnew, ynew], dtype=np.int32)
+        # Pack each (x, y) into one int64 so np.unique finds repeated pixels,
+        # then keep the first occurrence of each in contour order.
+        packed = (contour[:, 0].astype(np.int64) << 32) | (contour[:, 1].astype(np.int64) & 0xffffffff)
+        first = np.unique(packed, return_index=True)[1]
+        return contour[np.sort(first)]
 
 
     def get_interior_points(self, x, y):
@@ -691,145 +788,298 @@ class ApplyMakeup(DetectLandmarks):
 
         def ext(a, b, i):
             a, b = round(a), round(b)
-            intx.extend(arange(a, b, 1).tolist())
-            inty.extend((ones(b - a) * i).tolist())
+            intx.extend(np.arange(a, b, 1).tolist())
+            inty.extend((np.ones(b - a) * i).tolist())
 
         x, y = np.array(x), np.array(y)
-        xmin, xmax = amin(x), amax(x)
+        xmin, xmax = np.amin(x), np.amax(x)
         xrang = np.arange(xmin, xmax + 1, 1)
         for i in xrang:
-            ylist = y[where(x == i)]
-            ext(amin(ylist), amax(ylist), i)
+            ylist = y[np.where(x == i)]
+            ext(np.amin(ylist), np.amax(ylist), i)
         return np.array(intx, dtype=np.int32), np.array(inty, dtype=np.int32)
 
 
-    def apply_blush_color(self, r, g, b):
-        val = color.rgb2lab((self.image / 255.)).reshape(self.width * self.height, 3)
-        L, A, B = mean(val[:, 0]), mean(val[:, 1]), mean(val[:, 2])
-        L1, A1, B1 = color.rgb2lab(np.array((r / 255., g / 255., b / 255.)).reshape(1, 1, 3)).reshape(3, )
-        ll, aa, bb = (L1 - L) * BLUSH_INTENSIVITY, (A1 - A) * BLUSH_INTENSIVITY, (B1 - B) * BLUSH_INTENSIVITY
-        val[:, 0] = np.clip(val[:, 0] + ll, 0, 100)
-        val[:, 1] = np.clip(val[:, 1] + aa, -127, 128)
-        val[:, 2] = np.clip(val[:, 2] + bb, -127, 128)
-        self.image = color.lab2rgb(val.reshape(self.height, self.width, 3)) * 255
-
-    def apply_eyeshadow_color(self, r, g, b):
-        val = color.rgb2lab((self.image / 255.)).reshape(self.width * self.height, 3)
-        L, A, B = mean(val[:, 0]), mean(val[:, 1]), mean(val[:, 2])
-        L1, A1, B1 = color.rgb2lab(np.array((r / 255., g / 255., b / 255.)).reshape(1, 1, 3)).reshape(3, )
-        ll, aa, bb = (L1 - L) * EYESHADOWN_INTENSIVITY, (A1 - A) * EYESHADOWN_INTENSIVITY, (B1 - B) * EYESHADOWN_INTENSIVITY
-        val[:, 0] = np.clip(val[:, 0] + ll, 0, 100)
-        val[:, 1] = np.clip(val[:, 1] + aa, -127, 128)
-        val[:, 2] = np.clip(val[:, 2] + bb, -127, 128)
-        self.image = color.lab2rgb(val.reshape(self.height, self.width, 3)) * 255
-
-    def smoothen_blush(self, x, y):
-        imgBase = zeros((self.height, self.width))
-        cv2.fillConvexPoly(imgBase, np.array(c_[x, y], dtype='int32'), 1)
-        imgMask = cv2.GaussianBlur(imgBase, (201, 201), 0)
-        imgBlur3D = np.ndarray([self.height, self.width, 3], dtype='float')
-        imgBlur3D[:, :, 0] = imgMask
-        imgBlur3D[:, :, 1] = imgMask
-        imgBlur3D[:, :, 2] = imgMask
-        self.im_copy = (imgBlur3D * self.image + (1 - imgBlur3D) * self.im_copy).astype('uint8')
-
-    def smoothen_eyeshadow(self, x, y):
-        imgBase = zeros((self.height, self.width))
-        cv2.fillConvexPoly(imgBase, np.array(c_[x, y], dtype='int32'), 1)
-        imgMask = cv2.GaussianBlur(imgBase, (71, 71), 0)
-        
-        kernel = np.ones((12,12),np.uint8)
-        imgMask = cv2.erode(imgMask,kernel,iterations = 1)
-        
-        imgBlur3D = np.zeros([self.height, self.width, 3], dtype='float64')
-        imgBlur3D[:, :, 0] = imgMask
-        imgBlur3D[:, :, 1] = imgMask
-        imgBlur3D[:, :, 2] = imgMask
-        self.im_copy = (imgBlur3D * self.image + (1 - imgBlur3D) * self.im_copy).astype('uint8')
-        
-    def apply_eyeshadow(self, filename, list_points, reyeshadow, geyeshadow, beyeshadow):
-        self.red_eye = reyeshadow
-        self.green_eye = geyeshadow
-        self.blue_eye = beyeshadow
-        self.__read_image(filename)
-        
-        eyeshadow_rigth_x, eyeshadow_rigth_y = self.get_eyeshadows_right(self.image, list_points)
-        eyeshadow_left_x, eyeshadow_left_y = self.get_eyeshadows_left(self.image, list_points)
-        
-        eyeshadow_left_x, eyeshadow_left_y = self.get_boundary_points(eyeshadow_left_x, eyeshadow_left_y)
-        eyeshadow_rigth_x, eyeshadow_rigth_y = self.get_boundary_points(eyeshadow_rigth_x, eyeshadow_rigth_y)
-        eyeshadow_left_x, eyeshadow_left_y = self.get_interior_points(eyeshadow_left_x, eyeshadow_left_y)
-        eyeshadow_rigth_x, eyeshadow_rigth_y = self.get_interior_points(eyeshadow_rigth_x, eyeshadow_rigth_y)
-        
-        self.apply_eyeshadow_color(reyeshadow, geyeshadow, beyeshadow)
-        self.smoothen_eyeshadow(eyeshadow_left_x, eyeshadow_left_y)
-        self.smoothen_eyeshadow(eyeshadow_rigth_x, eyeshadow_rigth_y)
-
-        self.im_copy = cv2.cvtColor(self.im_copy, cv2.COLOR_BGR2RGB)
-        name = '_color_' + str(self.red_b) + '_' + str(self.green_b) + '_' + str(self.blue_b)
-        file_name = 'output_' + name + '.jpg'
-        cv2.imwrite(file_name, self.im_copy)
-        return file_name
-    
-    def apply_blush(self, filename, list_points, rblush, gblush, bblush):
-        self.red_b = rblush
-        self.green_b = gblush
-        self.blue_b = bblush
-        self.__read_image(filename)
-        
-        blush_rigth_x, blush_rigth_y = self.get_blushs_right(self.image, list_points)
-        blush_left_x, blush_left_y = self.get_blushs_left(self.image, list_points)
-        
-        blush_left_x, blush_left_y = self.get_boundary_points(blush_left_x, blush_left_y)
-        blush_rigth_x, blush_rigth_y = self.get_boundary_points(blush_rigth_x, blush_rigth_y)
-        blush_left_x, blush_left_y = self.get_interior_points(blush_left_x, blush_left_y)
-        blush_rigth_x, blush_rigth_y = self.get_interior_points(blush_rigth_x, blush_rigth_y)
-        
-        self.apply_blush_color(rblush, gblush, bblush)
-        self.smoothen_blush(blush_rigth_x, blush_rigth_y)
-        self.smoothen_blush(blush_left_x, blush_left_y)
-
-        self.im_copy = cv2.cvtColor(self.im_copy, cv2.COLOR_BGR2RGB)
-        name = '_color_' + str(self.red_b) + '_' + str(self.green_b) + '_' + str(self.blue_b)
-        file_name = 'output_' + name + '.jpg'
-        cv2.imwrite(file_name, self.im_copy)
-        return file_name
+    def __shift_lab(self, region, mask, rgb, intensity):
+        """ Shifts the Lab colour of region towards rgb at the given intensity.
+        The mean colour is taken over the pixels where mask is non-zero,
+        or over the whole region when mask is `None`. mask must have at
+        least one such pixel.
+        """
+        if self.lab_conversion == self.LAB_OPENCV:
+            # 8-bit Lab: L is scaled to 0..255, a and b are offset by 128.
+            val = cv2.cvtColor(region.astype(np.uint8), cv2.COLOR_RGB2LAB).astype(np.float32)
+            target = cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2LAB).reshape(3, )
+            low, high = (0, 0, 0), (255, 255, 255)
+        else:
+            from skimage import color
+            val = color.rgb2lab(region / 255.)
+            target = color.rgb2lab(np.array(rgb) / 255.)
+            low, high = (0, -127, -127), (100, 128, 128)
+        average = val.reshape(-1, 3).mean(axis=0) if mask is None else val[mask > 0].mean(axis=0)
+        val = np.clip(val + (target - average) * intensity, low, high)
+        if self.lab_conversion == self.LAB_OPENCV:
+            return cv2.cvtColor(np.round(val).astype(np.uint8), cv2.COLOR_LAB2RGB)
+        return color.lab2rgb(val) * 255
+
+    def apply_blush_color(self, canvas, r, g, b):
+        canvas.image = self.__shift_lab(canvas.image, None, (r, g, b), BLUSH_INTENSIVITY)
+
+    def apply_eyeshadow_color(self, canvas, r, g, b):
+        canvas.image = self.__shift_lab(canvas.image, None, (r, g, b), EYESHADOWN_INTENSIVITY)
+
+    def smoothen_blush(self, canvas, x, y, rgb=None, key=None, anchor=None, eye_distance=None):
+        """ Blends blush inside the region bounded by the ordered contour (x, y).
+        key and anchor identify the mask in canvas.masks, see MaskCache.
+        The feathering scales with eye_distance, the face's distance between the eyes.
+        """
+        points = np.array(np.c_[x, y], dtype='int32')
+        ksize = feather_size(BLUSH_FEATHER, eye_distance)
+        def build(rows, cols):
+            imgBase = np.zeros((rows.stop - rows.start, cols.stop - cols.start), np.float32)
+            cv2.fillPoly(imgBase, [points - (cols.start, rows.start)], 1)
+            return feather(imgBase, ksize)
+        roi = self.__feather_mask(canvas, points, ksize // 2, build, key, anchor)
+        if roi is None:
+            return
+        rows, cols, imgMask = roi
+        # A region just off the image can leave its mask empty, and the Lab
+        # mean of no pixels is NaN.
+        if not (imgMask > 0).any():
+            return
+        source = canvas.image[rows, cols]
+        if rgb is not None:
+            source = self.__shift_lab(source, imgMask, rgb, BLUSH_INTENSIVITY)
+        canvas.blend(rows, cols, source, imgMask)
+
+    def smoothen_eyeshadow(self, canvas, x, y, rgb=None, key=None, anchor=None, eye_distance=None):
+        """ Blends eyeshadow inside the region bounded by the ordered contour (x, y).
+        key and anchor identify the mask in canvas.masks, see MaskCache.
+        The feathering scales with eye_distance, the face's distance between the eyes.
+        """
+        points = np.array(np.c_[x, y], dtype='int32')
+        ksize = feather_size(EYESHADOW_FEATHER, eye_distance)
+        erode = int(round(EYESHADOW_ERODE * (eye_distance or REFERENCE_EYE_DISTANCE)))
+        def build(rows, cols):
+            imgBase = np.zeros((rows.stop - rows.start, cols.stop - cols.start), np.float32)
+            cv2.fillPoly(imgBase, [points - (cols.start, rows.start)], 1)
+            return feather(imgBase, ksize, erode)
+        # The erosion reads up to erode pixels past the blurred edge.
+        roi = self.__feather_mask(canvas, points, ksize // 2 + erode, build, key, anchor)
+        if roi is None:
+            return
+        rows, cols, imgMask = roi
+        if not (imgMask > 0).any():
+            return
+        source = canvas.image[rows, cols]
+        if rgb is not None:
+            source = self.__shift_lab(source, imgMask, rgb, EYESHADOWN_INTENSIVITY)
+        canvas.blend(rows, cols, source, imgMask)
         
-    def apply_lipstick(self, filename, list_points, rlips, glips, blips):
-
-        self.red_l = rlips
-        self.green_l = glips
-        self.blue_l = blips
-        self.__read_image(filename)
-        lips = self.get_lips(self.image, list_points)
-        lips = list([point.split() for point in lips.split('\n')])
-        lips_points = [item for sublist in lips for item in sublist]
-        uol, uil, lol, lil = self.__get_points_lips(lips_points)
-        uol_c, uil_c, lol_c, lil_c = self.__get_curves_lips(uol, uil, lol, lil)
-        self.__fill_color(uol_c, uil_c, lol_c, lil_c)
-        self.im_copy = cv2.cvtColor(self.im_copy, cv2.COLOR_BGR2RGB)
-        name = 'color_' + str(self.red_l) + '_' + str(self.green_l) + '_' + str(self.blue_l)
-        file_name = 'output_' + name + '.jpg'
-        cv2.imwrite(file_name, self.im_copy)
-        return file_name
+    # Every pass applies its effect on all faces of list_points before the
+    # next pass starts, so a group photo costs one decode and one encode.
+
+    def __eyeshadow_pass(self, canvas, list_points, rgb):
+        """ Applies eyeshadow of colour rgb on the canvas. """
+        for i, face in enumerate(detect_features.as_faces(list_points)):
+            distance = detect_features.eye_distance(face)
+            regions = self.get_makeup_regions(face)[1]
+            for j in reversed(range(len(regions))):
+                eyeshadow = regions[j]
+                contour = self.get_boundary_contour(eyeshadow[:, 0], eyeshadow[:, 1])
+                self.smoothen_eyeshadow(
+                    canvas, contour[:, 0], contour[:, 1], rgb, ('eyeshadow', i, j), eyeshadow, distance
+                )
+
+    def __blush_pass(self, canvas, list_points, rgb):
+        """ Applies blush of colour rgb on the canvas. """
+        for i, face in enumerate(detect_features.as_faces(list_points)):
+            distance = detect_features.eye_distance(face)
+            for j, blush in enumerate(self.get_makeup_regions(face)[0]):
+                contour = self.get_boundary_contour(blush[:, 0], blush[:, 1])
+                self.smoothen_blush(
+                    canvas, contour[:, 0], contour[:, 1], rgb, ('blush', i, j), blush, distance
+                )
+
+    def __lipstick_pass(self, canvas, list_points, rgb):
+        """ Applies lipstick of colour rgb on the canvas. """
+        for i, face in enumerate(detect_features.as_faces(list_points)):
+            lips = self.get_lips_points(face)
+            uol, uil, lol, lil = self.__get_points_lips(lips)
+            uol_c, uil_c, lol_c, lil_c = self.__get_curves_lips(uol, uil, lol, lil)
+            self.__fill_color(
+                canvas, rgb, uol_c, uil_c, lol_c, lil_c, ('lips', i), lips,
+                detect_features.eye_distance(face)
+            )
+
+    def __liner_pass(self, canvas, list_points):
+        """ Applies eyeliner on the canvas. """
+        for face in detect_features.as_faces(list_points):
+            self.__create_eye_liner(canvas, self.get_upper_eyelids_points(face))
+
+    def apply_eyeshadow(self, filename, list_points, reyeshadow, geyeshadow, beyeshadow,
+                        output_flag=None, output_path=None):
+        """
+        Applies eyeshadow on an input image.
+        ___________________________________
+        Args:
+            1. `filename (str)`: Path for stored input image file.
+            2. `list_points`: Landmarks returned by get_face_data().
+            3. `reyeshadow`, `geyeshadow`, `beyeshadow`: Colour of eyeshadow.
+            4. `output_flag`, `output_path`: Where the result goes, as in apply_lipstick.
 
-    def apply_liner(self, filename, list_points):
+        """
+        canvas = self.__read_image(filename)
+        self.__eyeshadow_pass(canvas, list_points, (reyeshadow, geyeshadow, beyeshadow))
+        name = 'eyeshadow_color_' + str(reyeshadow) + '_' + str(geyeshadow) + '_' + str(beyeshadow)
+        return self.__finish(canvas, 'output_' + name + '.jpg', output_flag, output_path)
+
+    def apply_blush(self, filename, list_points, rblush, gblush, bblush,
+                    output_flag=None, output_path=None):
+        """
+        Applies blush on an input image.
+        ___________________________________
+        Args:
+            1. `filename (str)`: Path for stored input image file.
+            2. `list_points`: Landmarks returned by get_face_data().
+            3. `rblush`, `gblush`, `bblush`: Colour of blush.
+            4. `output_flag`, `output_path`: Where the result goes, as in apply_lipstick.
+
+        """
+        canvas = self.__read_image(filename)
+        self.__blush_pass(canvas, list_points, (rblush, gblush, bblush))
+        name = 'blush_color_' + str(rblush) + '_' + str(gblush) + '_' + str(bblush)
+        return self.__finish(canvas, 'output_' + name + '.jpg', output_flag, output_path)
+
+    def apply_lipstick(self, filename, list_points, rlips, glips, blips,
+                       output_flag=None, output_path=None):
         """
         Applies lipstick on an input image.
         ___________________________________
         Args:
             1. `filename (str)`: Path for stored input image file.
+            2. `list_points`: Landmarks returned by get_face_data().
+            3. `rlips`, `glips`, `blips`: Colour of lipstick.
+            4. `output_flag`:
+                Where the result goes:\n
+                    a. FILE_WRITE (default): written to output_path, or to
+                       output_color_<r>_<g>_<b>.jpg in the current directory.\n
+                    b. TEMP_FILE: written to a uniquely named file in the temporary
+                       directory, so concurrent renders never overwrite each other.\n
+                    c. NETWORK_BYTE_STREAM: returned as JPEG bytes.\n
+                    d. IMAGE_DATA: returned as image data, as cv2.imread() would.\n\n
+            5. `output_path (str)`: Output file of FILE_WRITE.
 
         Returns:
-            `filepath (str)` of the saved output file, with applied lipstick.
+            `filepath (str)` of the saved output file, with applied lipstick,
+            or the image itself with NETWORK_BYTE_STREAM and IMAGE_DATA.
 
         """
-        self.__read_image(filename)
-        liner = self.get_upper_eyelids(self.image, list_points)
-        eyes_points = liner.split('\n\n')
-        self.__create_eye_liner(eyes_points)
-        self.im_copy = cv2.cvtColor(self.im_copy, cv2.COLOR_BGR2RGB)
-        name = '_color_' + str(self.red_l) + '_' + str(self.green_l) + '_' + str(self.blue_l)
-        file_name = 'output_' + name + '.jpg'
-        cv2.imwrite(file_name, self.im_copy)
-        return file_name
+        canvas = self.__read_image(filename)
+        self.__lipstick_pass(canvas, list_points, (rlips, glips, blips))
+        name = 'color_' + str(rlips) + '_' + str(glips) + '_' + str(blips)
+        return self.__finish(canvas, 'output_' + name + '.jpg', output_flag, output_path)
+
+    def apply_liner(self, filename, list_points, output_flag=None, output_path=None):
+        """
+        Applies eyeliner on an input image.
+        ___________________________________
+        Args:
+            1. `filename (str)`: Path for stored input image file.
+            2. `list_points`: Landmarks returned by get_face_data().
+            3. `output_flag`, `output_path`: Where the result goes, as in apply_lipstick.
+
+        Returns:
+            `filepath (str)` of the saved output file, with applied eyeliner.
+
+        """
+        canvas = self.__read_image(filename)
+        self.__liner_pass(canvas, list_points)
+        return self.__finish(canvas, 'output_liner.jpg', output_flag, output_path)
+
+    def render(self, image, list_points, lipstick=None, liner=False, blush=None, eyeshadow=None,
+               masks=None):
+        """
+        Applies several makeup effects on an RGB image held in memory.
+        Safe to call from several threads at once on the same instance.
+        ___________________________________
+        Args:
+            1. `image`: RGB image array. It is not modified.
+            2. `list_points`:
+                Landmarks returned by get_face_data(). Landmarks of several
+                faces, from get_face_data(..., all_faces=True), apply the look on every face.
+            3. `lipstick`: (r, g, b) colour of lipstick, or `None` to skip.
+            4. `liner (bool)`: Whether to apply black eyeliner.
+            5. `blush`: (r, g, b) colour of blush, or `None` to skip.
+            6. `eyeshadow`: (r, g, b) colour of eyeshadow, or `None` to skip.
+            7. `masks`:
+                MaskCache that keeps feather masks between calls, for consecutive
+                video frames. A cache must not be used by two renders at once.
+
+        Returns:
+            RGB image array with applied makeup.
+
+        """
+        canvas = MakeupCanvas(image, masks, self.buffer_pool)
+        # Effects paint their colour into canvas.image, so keep the caller's array intact.
+        canvas.image = canvas.copy(image)
+        # Passes run in the same order the bot used to chain the apply_* calls.
+        passes = []
+        if lipstick is not None:
+            passes.append(lambda: self.__lipstick_pass(canvas, list_points, lipstick))
+        if liner:
+            passes.append(lambda: self.__liner_pass(canvas, list_points))
+        if blush is not None:
+            passes.append(lambda: self.__blush_pass(canvas, list_points, blush))
+        if eyeshadow is not None:
+            passes.append(lambda: self.__eyeshadow_pass(canvas, list_points, eyeshadow))
+        for i, render in enumerate(passes):
+            if i > 0:
+                canvas.next_pass()
+            render()
+        result = canvas.im_copy
+        canvas.release(result=False)
+        return result
+
+    def apply_look(self, image, list_points, lipstick=None, liner=False, blush=None,
+                   eyeshadow=None, flag=None, output_flag=None, output_path=None):
+        """
+        Applies several makeup effects on an input image in a single pass.
+        The image is decoded once, every effect is rendered on the same
+        in-memory array, and the result is encoded once at the end.
+        ___________________________________
+        Args:
+            1. `image`:
+                Either of three options:\n
+                    a. File path of locally stored image file.\n
+                    b. Image data after being read with cv2.imread().\n
+                    c. Encoded image bytes, or a file-like object to read them from.\n\n
+            2. `list_points`:
+                Landmarks returned by get_face_data(). Landmarks of several
+                faces, from get_face_data(..., all_faces=True), apply the look on every face.
+            3. `lipstick`: (r, g, b) colour of lipstick, or `None` to skip.
+            4. `liner (bool)`: Whether to apply black eyeliner.
+            5. `blush`: (r, g, b) colour of blush, or `None` to skip.
+            6. `eyeshadow`: (r, g, b) colour of eyeshadow, or `None` to skip.
+            7. `flag`:
+                FILE_READ, IMAGE_DATA or NETWORK_BYTE_STREAM, denoting the type
+                of image parameter. By default its value is FILE_READ.
+            8. `output_flag`:
+                FILE_WRITE, TEMP_FILE, IMAGE_DATA or NETWORK_BYTE_STREAM, denoting
+                the type of the result, as in apply_lipstick. By default its value is FILE_WRITE.
+            9. `output_path (str)`:
+                Output file of FILE_WRITE. By default output_look.jpg in the current directory.
+
+        Returns:
+            With FILE_WRITE and TEMP_FILE, `filepath (str)` of the saved output file, with applied makeup.
+            With IMAGE_DATA, the image data as cv2.imread() would return it.
+            With NETWORK_BYTE_STREAM, the JPEG encoded bytes of the image.
+
+        """
+        decoded = self.__decode_input(image, flag)
+        result = self.render(decoded, list_points, lipstick, liner, blush, eyeshadow)
+        try:
+            return self.__write_output(result, 'output_look.jpg', output_flag, output_path)
+        finally:
+            if self.buffer_pool is not None:
+                self.buffer_pool.give(result)
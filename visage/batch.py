@@ -0,0 +1,288 @@
+"""
+This module contains the batch renderer.
+
+Renders a directory of images, or a CSV / JSON / JSONL manifest of (image, look)
+pairs, across a pool of worker processes. Where processes can be forked,
+the landmark predictor is loaded once in the parent and its memory is
+shared by every worker. Otherwise every worker loads it once and reuses
+it for all of its images.
+
+Usage:
+    python -m visage.batch photos/ -o out/ --lipstick 170,10,30 --liner
+    python -m visage.batch looks.csv -o out/ -j 8
+"""
+
+import argparse
+import csv
+import gc
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+from visage import detect_features
+from visage.apply_makeup import ApplyMakeup
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+LOOK_KEYS = ('lipstick', 'liner', 'blush', 'eyeshadow')
+
+# The ApplyMakeup instance of the current worker process.
+_MAKEUP = None
+
+
+def parse_color(value):
+    """ Returns an (r, g, b) tuple from '#rrggbb', 'r,g,b', 'r g b' or a sequence.
+    Empty values return `None`, meaning the effect is skipped.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('#'):
+            return tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+        value = value.replace(',', ' ').replace(';', ' ').split()
+    color = tuple(int(channel) for channel in value)
+    if len(color) != 3:
+        raise ValueError('Expected 3 colour channels, got %r' % (value,))
+    return color
+
+
+def parse_flag(value):
+    """ Returns a bool from a manifest cell such as 'yes', '1' or 'true'. """
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+
+def make_look(record, defaults=None):
+    """ Returns the keyword arguments of ApplyMakeup.render from a manifest record.
+    Look keys that are missing or empty in record are taken from defaults.
+    """
+    look = {'lipstick': None, 'liner': False, 'blush': None, 'eyeshadow': None}
+    look.update(defaults or {})
+    for key in LOOK_KEYS:
+        value = record.get(key)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        look[key] = parse_flag(value) if key == 'liner' else parse_color(value)
+    return look
+
+
+def read_manifest(path):
+    """ Reads the records of a CSV, JSON or JSONL manifest.
+    A JSON manifest holds a list of objects, a JSONL manifest one object per
+    line. Every record names an `image`, and optionally an `output` path and
+    the look keys `lipstick`, `liner`, `blush` and `eyeshadow`.
+    """
+    with open(path, newline='') as manifest:
+        if path.lower().endswith('.json'):
+            records = json.load(manifest)
+            if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+                raise ValueError('%s: expected a list of objects' % path)
+            return records
+        if path.lower().endswith('.jsonl'):
+            return [json.loads(line) for line in manifest if line.strip()]
+        return list(csv.DictReader(manifest))
+
+
+def load_jobs(source, output_dir, look=None):
+    """
+    Lists the render jobs of a directory or manifest.
+    ___________________________________
+    Args:
+        1. `source (str)`: Directory of images, or path of a .csv / .json / .jsonl manifest.
+        2. `output_dir (str)`: Directory the rendered images are written to.
+        3. `look (dict)`:
+            Look applied to every image of a directory. For a manifest, the
+            default of every look key left empty in a record.
+
+    Returns:
+        List of `(image_path, look, output_path)` tuples.
+
+    """
+    if os.path.isdir(source):
+        look = look or {}
+        return [
+            (os.path.join(source, name), look, os.path.join(output_dir, name))
+            for name in sorted(os.listdir(source))
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    root = os.path.dirname(os.path.abspath(source))
+    jobs = []
+    for record in read_manifest(source):
+        image = os.path.join(root, record['image'])
+        output = record.get('output') or os.path.basename(image)
+        jobs.append((image, make_look(record, look), os.path.join(output_dir, output)))
+    return jobs
+
+
+def process_memory(pid='self'):
+    """ Returns the memory use of a process, in kB, from /proc/<pid>/smaps_rollup.
+    `pss` counts shared pages divided between the processes sharing them, so
+    it shows what each worker really adds. Returns `None` where it is unavailable.
+    """
+    fields = {}
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as smaps:
+            for line in smaps:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+    except (IOError, OSError):
+        return None
+    return {
+        'pid': os.getpid() if pid == 'self' else pid,
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def format_memory(reports):
+    """ Formats process_memory() reports as a table, with a total line. """
+    lines = ['%8s %10s %10s %10s %10s' % ('pid', 'rss kB', 'pss kB', 'shared kB', 'private kB')]
+    reports = [report for report in reports if report]
+    for report in reports:
+        lines.append('%(pid)8s %(rss)10d %(pss)10d %(shared)10d %(private)10d' % report)
+    lines.append('%8s %10d %10d' % (
+        'total', sum(report['rss'] for report in reports), sum(report['pss'] for report in reports)
+    ))
+    return '\n'.join(lines)
+
+
+def _init_worker(makeup_kwargs):
+    """ Loads the detector and predictor once per worker process. """
+    global _MAKEUP
+    # Workers already use every core, so keep OpenCV from spawning threads of its own.
+    cv2.setNumThreads(1)
+    _MAKEUP = ApplyMakeup(**makeup_kwargs)
+
+
+def _render_job(job):
+    """ Renders one job in a worker. Returns `(image_path, output_path, error)`. """
+    image_path, look, output_path = job
+    try:
+        image = cv2.imread(image_path)
+        if image is None:
+            return image_path, None, 'Could not read image'
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        landmarks = _MAKEUP.get_face_data(image, _MAKEUP.IMAGE_DATA, all_faces=True)
+        if landmarks is None:
+            return image_path, None, 'No face found'
+        result = _MAKEUP.render(image, landmarks, **look)
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not cv2.imwrite(output_path, cv2.cvtColor(result, cv2.COLOR_RGB2BGR)):
+            return image_path, None, 'Could not write output'
+        return image_path, output_path, None
+    except Exception as error:
+        return image_path, None, str(error)
+
+
+def render_batch(jobs, workers=None, chunksize=4, preload=True, report=None, **makeup_kwargs):
+    """
+    Renders jobs across a process pool.
+    ___________________________________
+    Args:
+        1. `jobs`: `(image_path, look, output_path)` tuples, as returned by load_jobs().
+        2. `workers (int)`: Number of worker processes. Defaults to the number of CPUs.
+        3. `chunksize (int)`: Number of jobs sent to a worker at a time.
+        4. `preload (bool)`:
+            Load the predictor in this process and fork the workers from it, so
+            they share its pages copy-on-write. Ignored where fork is unavailable.
+        5. `report`:
+            Called with the process_memory() reports of this process and of every
+            worker once all jobs are done, while the workers are still alive.
+        6. `makeup_kwargs`: Keyword arguments of ApplyMakeup, used in every worker.
+
+    Yields:
+        `(image_path, output_path, error)` for every job, in the order of jobs.
+        `output_path` is `None` and `error` describes the failure if a job failed.
+
+    """
+    context = None
+    frozen = False
+    if preload and 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        detect_features.preload(makeup_kwargs.get('predictor_path', detect_features.PREDICTOR_PATH))
+        # Keep the collector from writing to the objects inherited by the workers.
+        gc.freeze()
+        frozen = True
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=context,
+                initializer=_init_worker, initargs=(makeup_kwargs,)
+        ) as executor:
+            results = executor.map(_render_job, jobs, chunksize=chunksize)
+            # map() has submitted every job, and with fork the pool starts all
+            # of its workers on the first submit, so they are forked by now.
+            if frozen:
+                gc.unfreeze()
+                frozen = False
+            for result in results:
+                yield result
+            if report is not None:
+                report([process_memory()] + [
+                    process_memory(child.pid) for child in multiprocessing.active_children()
+                ])
+    finally:
+        if frozen:
+            gc.unfreeze()
+
+
+def main(argv=None):
+    """ Command line entry point. Returns 1 if any image failed, else 0. """
+    parser = argparse.ArgumentParser(
+        prog='visage-batch',
+        description='Apply virtual makeup to a directory or manifest of face images.'
+    )
+    parser.add_argument('source', help='directory of images, or a .csv / .json / .jsonl manifest')
+    parser.add_argument('-o', '--output-dir', default='output', help='directory for rendered images')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument(
+        '--lipstick', type=parse_color,
+        help='lipstick colour of a directory, or of manifest rows that leave it empty, e.g. 170,10,30'
+    )
+    parser.add_argument('--liner', action='store_true', help='apply eyeliner, unless a manifest row says otherwise')
+    parser.add_argument('--blush', type=parse_color, help='blush colour, as for --lipstick')
+    parser.add_argument('--eyeshadow', type=parse_color, help='eyeshadow colour, as for --lipstick')
+    parser.add_argument(
+        '--detector', default=ApplyMakeup.DLIB_HOG,
+        choices=(ApplyMakeup.DLIB_HOG, ApplyMakeup.OPENCV_HAAR, ApplyMakeup.OPENCV_DNN),
+        help='face detector backend'
+    )
+    parser.add_argument('--dnn-model', help='model file of the opencv_dnn detector')
+    parser.add_argument('--dnn-config', help='config file of the opencv_dnn detector')
+    parser.add_argument(
+        '--no-preload', action='store_true',
+        help='load the predictor in every worker instead of sharing it from the parent'
+    )
+    parser.add_argument(
+        '--memory-report', action='store_true', help='print the memory use of every process'
+    )
+    args = parser.parse_args(argv)
+
+    look = {key: getattr(args, key) for key in LOOK_KEYS}
+    jobs = load_jobs(args.source, args.output_dir, look)
+    failed = 0
+    report = None
+    if args.memory_report:
+        report = lambda reports: print(format_memory(reports), file=sys.stderr)
+    results = render_batch(
+        jobs, args.workers, preload=not args.no_preload, report=report,
+        detector_backend=args.detector, dnn_model=args.dnn_model, dnn_config=args.dnn_config
+    )
+    for image_path, output_path, error in results:
+        if error:
+            failed += 1
+            print('%s: %s' % (image_path, error), file=sys.stderr)
+        else:
+            print('%s -> %s' % (image_path, output_path))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,15 +5,213 @@ Created on Mon Mar 20 12:28:21 2017
 This module contains the DetectLandmark class.
 """
 
+import hashlib
 import os.path
 import sys
+import threading
+from collections import OrderedDict
 from urllib.request import urlretrieve
 import cv2
-import dlib
 import numpy
+# dlib is imported where it is used, so that importing visage stays cheap
+# and the predictor is only read from disk the first time it is needed.
 
 PREDICTOR_PATH = "shape_predictor_68_face_landmarks.dat"
-CASC_PATH = "haarcascade_frontalface_default.xml"
+CASC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "haarcascade_frontalface_default.xml")
+DETECT_MAX_SIDE = 640
+FAST_DETECT_MAX_SIDE = 320
+# Input size and BGR mean of OpenCV's res10 SSD face detector.
+DNN_INPUT_SIZE = 300
+DNN_MEAN = (104.0, 177.0, 123.0)
+DNN_CONFIDENCE = 0.5
+PREDICTOR_URL = 'https://github.com/hriddhidey/visage/blob/master/visage/shape_predictor_68_face_landmarks.dat?raw=true'
+
+# Shape predictors loaded by this process, by absolute path. They are safe
+# to share between threads, so every DetectLandmarks uses the same copy.
+_PREDICTORS = {}
+_PREDICTORS_LOCK = threading.Lock()
+
+# Named groups of the 68 landmarks returned by get_face_data.
+JAW = slice(0, 17)
+RIGHT_BROW = slice(17, 22)
+LEFT_BROW = slice(22, 27)
+NOSE = slice(27, 36)
+RIGHT_EYE = slice(36, 42)
+LEFT_EYE = slice(42, 48)
+RIGHT_UPPER_EYELID = slice(36, 40)
+LEFT_UPPER_EYELID = slice(42, 46)
+LIPS = slice(48, 68)
+
+
+def as_landmarks(points):
+    """ Returns landmarks as a 68x2 int32 array of (x, y) rows.
+    Also accepts the numpy.matrix returned by older versions of get_face_data.
+    """
+    return numpy.asarray(points, dtype=numpy.int32).reshape(-1, 2)
+
+
+def as_faces(points):
+    """ Returns landmarks of one or more faces as an Nx68x2 int32 array. """
+    return as_landmarks(points).reshape(-1, 68, 2)
+
+
+def eye_distance(face):
+    """ Returns the distance between the centres of the eyes of one face's landmarks. """
+    face = numpy.asarray(face, dtype=numpy.float64).reshape(-1, 2)
+    return float(numpy.linalg.norm(face[LEFT_EYE].mean(axis=0) - face[RIGHT_EYE].mean(axis=0)))
+
+
+def format_points(points):
+    """ Formats (x, y) rows as the newline separated string used by get_lips. """
+    return ''.join('%d %d\n' % (x, y) for x, y in points)
+
+
+def read_bytes(stream):
+    """ Returns the encoded bytes of a file-like object, or the bytes-like object itself. """
+    if hasattr(stream, 'read'):
+        return stream.read()
+    return stream
+
+
+def decode_image(data):
+    """ Decodes encoded image bytes to an RGB array. Returns `None` if decoding fails. """
+    image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def download_predictor(path=PREDICTOR_PATH):
+    """ Downloads the predictor file to path.
+    Raises:
+        `IOError`, if download of predictor fails.
+    """
+    try:
+        print ('Predictor not found. Downloading...this may take a while...')
+        def dl_progress(count, block_size, total_size):
+            """ Show download progress bar. """
+            percent = int(count*block_size*100/total_size)
+            sys.stdout.write("\r" + 'Progress:' + "...%d%%" % percent)
+            sys.stdout.flush()
+        urlretrieve(
+            PREDICTOR_URL,
+            path,
+            reporthook=dl_progress
+        )
+        print ('Predictor downloaded.')
+    except IOError:
+        print ('Download failed. Try again with reliable network connection.')
+        raise IOError
+
+
+def load_predictor(path=PREDICTOR_PATH):
+    """ Returns the process-wide shape predictor read from path.
+    The file is downloaded first if it is not available, and read only once
+    per process however many DetectLandmarks instances use it.
+    """
+    key = os.path.abspath(path)
+    predictor = _PREDICTORS.get(key)
+    if predictor is None:
+        with _PREDICTORS_LOCK:
+            predictor = _PREDICTORS.get(key)
+            if predictor is None:
+                import dlib
+                if not os.path.isfile(path):
+                    download_predictor(path)
+                predictor = _PREDICTORS[key] = dlib.shape_predictor(path)
+    return predictor
+
+
+def preload(predictor_path=PREDICTOR_PATH):
+    """ Loads the shape predictor before worker processes are forked.
+    Call it in a parent process, e.g. from a gunicorn config with
+    `preload_app = True`. Forked workers then share the predictor's
+    memory pages copy-on-write instead of each reading its own copy.
+    """
+    return load_predictor(predictor_path)
+
+
+def scale_rects(rects, factor):
+    """ Returns dlib rectangles with every coordinate multiplied by factor. """
+    import dlib
+    return [
+        dlib.rectangle(
+            int(rect.left() * factor), int(rect.top() * factor),
+            int(rect.right() * factor), int(rect.bottom() * factor)
+        )
+        for rect in rects
+    ]
+
+
+def content_key(data):
+    """ Returns a hex digest of encoded image bytes, or of decoded pixels and their shape. """
+    digest = hashlib.sha1()
+    if isinstance(data, numpy.ndarray):
+        digest.update(('%s %s' % (data.shape, data.dtype.str)).encode())
+        data = numpy.ascontiguousarray(data)
+    digest.update(memoryview(data))
+    return digest.hexdigest()
+
+
+class LandmarkCache(object):
+    """
+    LRU cache of detected landmarks, keyed by content_key() of the image.
+
+    Faces that were not found are cached too, so repeated uploads of a photo
+    without a face are not run through detection again. Safe to share
+    between threads.
+    """
+
+    def __init__(self, max_entries=256, cache_dir=None):
+        """ Initiator for LandmarkCache class.
+        Args:
+            1. `max_entries`: Number of images kept in memory.
+            2. `cache_dir`:
+                Directory where landmarks are also stored as .npy files, so they
+                outlive the process. `None` keeps the cache in memory only.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """ Returns `(found, landmarks)`. landmarks is `None` for images without a face. """
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                return True, self.__entries[key]
+        if self.cache_dir is None or not os.path.isfile(self.__path(key)):
+            return False, None
+        try:
+            landmarks = numpy.load(self.__path(key))
+        except (IOError, ValueError):
+            return False, None
+        landmarks = landmarks if len(landmarks) else None
+        self.__remember(key, landmarks)
+        return True, landmarks
+
+    def put(self, key, landmarks):
+        """ Stores landmarks, or `None` for an image without a face. """
+        self.__remember(key, landmarks)
+        if self.cache_dir is not None:
+            stored = numpy.empty((0, 2), numpy.int32) if landmarks is None else landmarks
+            # Write under a temporary name so readers never see a partial file.
+            temp_path = '%s.%d.%d.npy' % (self.__path(key)[:-4], os.getpid(), threading.get_ident())
+            numpy.save(temp_path, stored)
+            os.replace(temp_path, self.__path(key))
+
+    def __remember(self, key, landmarks):
+        with self.__lock:
+            self.__entries[key] = landmarks
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
 
 
 class DetectLandmarks(object):
@@ -30,54 +228,250 @@ class DetectLandmarks(object):
     FILE_READ = 'FILE_READ'
     NETWORK_BYTE_STREAM = 'NETWORK_BYTE_STREAM'
 
+    DLIB_HOG = 'dlib_hog'
+    OPENCV_HAAR = 'opencv_haar'
+    OPENCV_DNN = 'opencv_dnn'
+
 
 
-    def __init__(self):
+    def __init__(self, detect_max_side=DETECT_MAX_SIDE, upsample=None, cache=None,
+                 detector_backend=DLIB_HOG, dnn_model=None, dnn_config=None,
+                 predictor_path=PREDICTOR_PATH, full_resolution_fallback=False):
         """ Initiator for DetectLandmarks class.
-        Downloads the predictor file if not available.
+        Models are loaded on first use. The predictor file is downloaded then
+        if not available, and shared with every other instance of the process.
+        Args:
+            1. `detect_max_side`:
+                Faces are detected on a copy of the image downscaled so that its
+                longest side is at most this many pixels. Landmarks are still
+                predicted on the full resolution image. If no face is found on the
+                downscaled copy, it is searched again upsampled once more.
+                `None` disables downscaling.
+            2. `upsample`:
+                Number of times the detector upsamples the image. By default the
+                image is upsampled once only when it was not downscaled.
+            3. `cache`:
+                LandmarkCache used by get_face_data, so an image seen before is
+                not detected again. `None` disables caching.
+            4. `detector_backend`:
+                Face detector whose rectangles are passed to the shape predictor:\n
+                    a. DLIB_HOG: dlib's HOG detector (default), which the predictor
+                       was trained with.\n
+                    b. OPENCV_HAAR: OpenCV's Haar cascade. Much faster on large
+                       frontal faces, less accurate on turned ones.\n
+                    c. OPENCV_DNN: OpenCV's DNN face detector, loaded from local
+                       dnn_model and dnn_config files, e.g. the res10 SSD
+                       .caffemodel and deploy.prototxt.\n\n
+                `upsample` only applies to DLIB_HOG and OPENCV_HAAR.
+            5. `dnn_model`, `dnn_config`: Model files of OPENCV_DNN.
+            6. `predictor_path`: Path of the 68-point shape predictor file.
+            7. `full_resolution_fallback`:
+                As a last resort, search the full resolution image, upsampled
+                once, when the downscaled copy has no face. Finds the smallest
+                faces, but takes many seconds on large photos without one.
         Raises:
-            `Exception`, if download of predictor fails.
+            `ValueError`, if the detector backend is unknown or its model is missing.
+            Models that exist but cannot be read raise on first use, from
+            get_face_data() and has_face(), instead of passing for "no face".
         """
-        if not os.path.isfile(PREDICTOR_PATH):
-            try:
-                print ('Predictor not found. Downloading...this may take a while...')
-                url = 'https://github.com/hriddhidey/visage/blob/master/visage/shape_predictor_68_face_landmarks.dat?raw=true'
-                def dl_progress(count, block_size, total_size):
-                    """ Show download progress bar. """
-                    percent = int(count*block_size*100/total_size)
-                    sys.stdout.write("\r" + 'Progress:' + "...%d%%" % percent)
-                    sys.stdout.flush()
-                urlretrieve(
-                    url,
-                    PREDICTOR_PATH,
-                    reporthook=dl_progress
+        if detector_backend not in (self.DLIB_HOG, self.OPENCV_HAAR, self.OPENCV_DNN):
+            raise ValueError('Unknown detector backend: %r' % (detector_backend,))
+        if detector_backend == self.OPENCV_DNN and not (dnn_model and os.path.isfile(dnn_model)):
+            raise ValueError('OPENCV_DNN needs the path of a local dnn_model file')
+        if detector_backend == self.OPENCV_DNN and dnn_config and not os.path.isfile(dnn_config):
+            raise ValueError('dnn_config file not found: ' + dnn_config)
+        if detector_backend == self.OPENCV_HAAR and not os.path.isfile(CASC_PATH):
+            raise ValueError('OPENCV_HAAR needs the cascade file ' + CASC_PATH)
+        self.predictor_path = predictor_path
+        self.full_resolution_fallback = full_resolution_fallback
+        self.detector_backend = detector_backend
+        self.dnn_model = dnn_model
+        self.dnn_config = dnn_config
+        # The detectors keep scratch state while scanning, so every thread
+        # gets its own copy. The shape predictor is safe to share.
+        self.__local = threading.local()
+        self.detect_max_side = detect_max_side
+        self.upsample = upsample
+        self.cache = cache
+
+
+
+    @property
+    def predictor(self):
+        """ The shape predictor, loaded and downloaded on first use. """
+        return load_predictor(self.predictor_path)
+
+
+
+    @property
+    def detector(self):
+        """ The face detector of the calling thread.
+        Called as detector(rgb_image, upsample), it returns dlib rectangles.
+        """
+        detector = getattr(self.__local, 'detector', None)
+        if detector is None:
+            detector = self.__local.detector = self.__create_detector()
+        return detector
+
+
+
+    def __create_detector(self):
+        """ Creates a detector of self.detector_backend. """
+        import dlib
+        if self.detector_backend == self.OPENCV_HAAR:
+            cascade = cv2.CascadeClassifier(CASC_PATH)
+            if cascade.empty():
+                raise IOError('Could not load ' + CASC_PATH)
+
+            def detect_haar(image, upsample=0):
+                """ Haar cascade detection on the grey image. """
+                factor = 2 ** upsample
+                gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+                if factor != 1:
+                    gray = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+                faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(40, 40))
+                return [
+                    dlib.rectangle(
+                        int(x / factor), int(y / factor), int((x + w) / factor), int((y + h) / factor)
+                    )
+                    for (x, y, w, h) in faces
+                ]
+            return detect_haar
+
+        if self.detector_backend == self.OPENCV_DNN:
+            net = cv2.dnn.readNet(self.dnn_model, self.dnn_config or '')
+
+            def detect_dnn(image, upsample=0):
+                """ SSD detection on the image resized to the network input. """
+                height, width = image.shape[:2]
+                blob = cv2.dnn.blobFromImage(
+                    cv2.resize(image, (DNN_INPUT_SIZE, DNN_INPUT_SIZE)), 1.0,
+                    (DNN_INPUT_SIZE, DNN_INPUT_SIZE), DNN_MEAN, swapRB=True
                 )
-                print ('Predictor downloaded.')
-            except IOError:
-                print ('Download failed. Try again with reliable network connection.')
-                raise IOError
-        self.predictor = dlib.shape_predictor(PREDICTOR_PATH)
-        self.cascade = cv2.CascadeClassifier(CASC_PATH)
-        self.detector = dlib.get_frontal_face_detector()
+                net.setInput(blob)
+                detections = net.forward().reshape(-1, 7)
+                detections = detections[detections[:, 2] > DNN_CONFIDENCE]
+                boxes = numpy.clip(detections[:, 3:7], 0, 1) * (width, height, width, height)
+                return [dlib.rectangle(*(int(value) for value in box)) for box in boxes]
+            return detect_dnn
 
+        return dlib.get_frontal_face_detector()
 
 
-    def __get_landmarks(self, image):
+
+    def __detect_faces(self, image, max_side, upsample, fallback=True, detector=None):
+        """ Detect faces on a copy of the image downscaled to at most max_side.
+        Returns the face rectangles mapped back to full resolution.
+        With fallback, faces too small to be found on the downscaled copy
+        are looked for again on it upsampled once more, which costs about as
+        much as detecting on a 2 * max_side image whatever the resolution.
+        Only with full_resolution_fallback is the full resolution image
+        searched last, upsampled once unless upsample says otherwise.
+        detector defaults to the detector of the calling thread.
+        """
+        if detector is None:
+            detector = self.detector
+        longest = max(image.shape[:2])
+        if not max_side or longest <= max_side:
+            return detector(image, 1 if upsample is None else upsample)
+        scale = float(max_side) / longest
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        upsample = 0 if upsample is None else upsample
+        # The DNN detector resizes to its input size, so a retry finds nothing new.
+        fallback = fallback and self.detector_backend != self.OPENCV_DNN
+        rects = detector(small, upsample)
+        if not len(rects) and fallback:
+            rects = detector(small, upsample + 1)
+        if not len(rects) and fallback and self.full_resolution_fallback:
+            return detector(image, max(upsample, 1))
+        return scale_rects(rects, 1 / scale)
+
+
+
+    def __get_landmarks(self, image, all_faces=False, rects=None, cache_key=None):
         """ Extract the landmarks from a given image. 
         Returns `None` if no landmarks found.
+        With cache_key, the result is stored in self.cache, unless detection
+        failed with an exception.
         """
+        # Load the models first, so a missing or broken file, a failed
+        # download or a backend that fails to load raises instead of being
+        # reported (and cached) as an image without a face.
+        predictor = self.predictor
+        detector = self.detector
         try:
-            rects = self.detector(image, 1)
-            size = len(rects)
-            if size == 0:
-                return None, None
-            return numpy.matrix([[p.x, p.y] for p in self.predictor(image, rects[0]).parts()])
+            if rects is None:
+                rects = self.__detect_faces(
+                    image, self.detect_max_side, self.upsample, detector=detector
+                )
+            if not all_faces:
+                rects = rects[:1]
+            faces = [[[p.x, p.y] for p in predictor(image, rect).parts()] for rect in rects]
         except Exception:
             return None
+        landmarks = None
+        if faces:
+            faces = numpy.array(faces, dtype=numpy.int32)
+            landmarks = faces if all_faces else faces[0]
+        if cache_key is not None:
+            self.cache.put(cache_key, None if landmarks is None else landmarks.copy())
+        return landmarks
+
+
+
+    def has_face(self, image_file, flag=None, fast=True):
+        """
+        Checks whether a given image contains a face, without predicting landmarks.
+        ______________________________________________
+        Args:
+            1. `image_file`: Image, as for get_face_data().
+            2. `flag`: Type of image_file, as for get_face_data().
+            3. `fast (bool)`:
+                Detect on a thumbnail with its longest side at most
+                FAST_DETECT_MAX_SIDE pixels, without upsampling. Encoded JPEG
+                images are decoded straight to quarter size. Faces that fill
+                less than about a quarter of the photo may be missed.
+
+        Returns:
+            List of face rectangles at full resolution. Pass it to
+            get_face_data() as `rects` so the faces are not detected again.
+
+        Error:
+            Returns `None` if face not found in image.
+
+        """
+        factor = 1
+        if flag in (self.FILE_READ, self.NETWORK_BYTE_STREAM):
+            if flag == self.FILE_READ:
+                with open(image_file, 'rb') as stream:
+                    data = stream.read()
+            else:
+                data = read_bytes(image_file)
+            image = None
+            if fast:
+                image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_REDUCED_COLOR_4)
+                if image is not None and max(image.shape[:2]) >= FAST_DETECT_MAX_SIDE:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    factor = 4
+                else:
+                    image = None
+            if image is None:
+                image = decode_image(data)
+        else:
+            image = image_file
+        if image is None:
+            return None
+        if fast:
+            rects = self.__detect_faces(image, FAST_DETECT_MAX_SIDE, 0, fallback=False)
+        else:
+            rects = self.__detect_faces(image, self.detect_max_side, self.upsample)
+        if len(rects) == 0:
+            return None
+        return scale_rects(rects, factor) if factor != 1 else list(rects)
 
 
 
-    def get_face_data(self, image_file, flag):
+    def get_face_data(self, image_file, flag, all_faces=False, rects=None):
         """
         Returns all facial landmarks in a given image.
         ______________________________________________
@@ -86,33 +480,63 @@ class DetectLandmarks(object):
                 Either of three options:\n
                     a. (int) Image data after being read with cv2.imread()\n
                     b. File path of locally stored image file.\n
-                    c. Byte stream being received over multipart network request.\n\n
+                    c. Encoded image bytes, or a file-like object to read them from,
+                       such as a stream received over multipart network request.\n\n
             2. `flag`:
                 Used to denote the type of image_file parameter being passed.
                 Possible values are IMG_DATA, FILE_READ, NETWORK_BYTE_STREAM respectively.
                 By default its value is IMAGE_DATA, and assumes imread() image is passed.
+            3. `all_faces (bool)`:
+                Return the landmarks of every detected face instead of the first one.
+            4. `rects`:
+                Face rectangles returned by has_face(). Landmarks are predicted
+                inside them and detection is skipped.
 
         Returns:
-            String with list of detected points of lips.
+            68x2 int32 array of (x, y) landmark points. The named slices
+            JAW, RIGHT_BROW, LEFT_BROW, NOSE, RIGHT_EYE, LEFT_EYE and LIPS
+            of this module select the facial parts.
+            With `all_faces`, an Nx68x2 array with one such array per face.
 
         Error:
             Returns `None` if face not found in image.
 
         """
+        if self.cache is not None:
+            return self.__get_cached_landmarks(image_file, flag, all_faces, rects)
         image = 0
         if flag == self.FILE_READ:
             image = cv2.imread(image_file)
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         elif flag == self.NETWORK_BYTE_STREAM:
-            image = cv2.imdecode(
-                numpy.fromstring(image_file.read(), numpy.uint8), cv2.IMREAD_UNCHANGED
-            )
+            image = decode_image(read_bytes(image_file))
         elif flag == self.IMAGE_DATA or flag is None:
             image = image_file
-        landmarks = self.__get_landmarks(image)
-        if landmarks[0] is None or landmarks[1] is None:
-            return None
-        return landmarks
+        return self.__get_landmarks(image, all_faces, rects)
+
+
+
+    def __get_cached_landmarks(self, image_file, flag, all_faces, rects):
+        """ get_face_data through self.cache.
+        Files and byte streams are keyed by their encoded bytes, so a cache hit
+        does not decode the image at all. Image data is keyed by its pixels.
+        """
+        data = None
+        if flag == self.FILE_READ:
+            with open(image_file, 'rb') as image:
+                data = image.read()
+        elif flag == self.NETWORK_BYTE_STREAM:
+            data = read_bytes(image_file)
+        key = content_key(image_file if data is None else data) + ('-all' if all_faces else '')
+        found, landmarks = self.cache.get(key)
+        if found:
+            # Callers own the returned array, the cached one must stay intact.
+            return None if landmarks is None else landmarks.copy()
+        if data is not None:
+            image = decode_image(data)
+        else:
+            image = image_file
+        return self.__get_landmarks(image, all_faces, rects, key)
 
 
 
@@ -141,10 +565,7 @@ class DetectLandmarks(object):
         landmarks = self.get_face_data(image_file, flag)
         if landmarks is None:
             return None
-        lips = ""
-        for point in landmarks[48:]:
-            lips += str(point).replace('[', '').replace(']', '') + '\n'
-        return lips
+        return format_points(landmarks[LIPS])
 
 
 
@@ -173,10 +594,4 @@ class DetectLandmarks(object):
         landmarks = self.get_face_data(image_file, flag)
         if landmarks is None:
             return None
-        liner = ""
-        for point in landmarks[36:40]:
-            liner += str(point).replace('[', '').replace(']', '') + '\n'
-        liner += '\n'
-        for point in landmarks[42:46]:
-            liner += str(point).replace('[', '').replace(']', '') + '\n'
-        return liner
+        return format_points(landmarks[RIGHT_UPPER_EYELID]) + '\n' + format_points(landmarks[LEFT_UPPER_EYELID])
@@ -0,0 +1,348 @@
+"""
+This module contains the video renderer.
+
+Applies a makeup look to the frames of a video file or camera. Faces are
+detected only on keyframes, and the 68 landmarks are tracked between them
+with pyramidal Lucas-Kanade optical flow, so most frames skip detection
+and the shape predictor altogether. The landmarks are smoothed over time
+with a One-Euro filter, and the feather masks of the previous frame are
+reused or warped while the face moves rigidly.
+
+Usage:
+    python -m visage.video input.mp4 -o output.mp4 --lipstick 170,10,30 --liner
+    python -m visage.video 0 --lipstick 170,10,30 --show
+"""
+
+import argparse
+import sys
+import cv2
+import numpy as np
+from visage import detect_features
+from visage.apply_makeup import ApplyMakeup, MaskCache
+from visage.batch import parse_color
+
+KEYFRAME_INTERVAL = 30
+MIN_TRACKED_FRACTION = 0.8
+MAX_FLOW_ERROR = 1.5
+FLOW_WINDOW = (21, 21)
+FLOW_LEVELS = 3
+SMOOTHING_MIN_CUTOFF = 1.0
+SMOOTHING_BETA = 0.02
+DEFAULT_FPS = 25.0
+
+
+def match_faces(previous, faces):
+    """
+    Matches re-detected faces to the faces of the previous frame.
+    ___________________________________
+    Args:
+        1. `previous`: Nx68x2 landmarks of the previous frame.
+        2. `faces`: Nx68x2 landmarks detected on the current frame.
+
+    Returns:
+        Index array `order` such that `faces[order][i]` is the same person as
+        `previous[i]`, or `None` if the faces differ in number, or any face
+        moved further than its distance between the eyes.
+
+    """
+    if len(previous) != len(faces):
+        return None
+    centres = faces.mean(axis=1)
+    order = []
+    for face in previous:
+        distances = np.linalg.norm(centres - face.mean(axis=0), axis=1)
+        nearest = int(np.argmin(distances))
+        if nearest in order or distances[nearest] > detect_features.eye_distance(face):
+            return None
+        order.append(nearest)
+    return np.array(order)
+
+
+class LandmarkTracker(object):
+    """
+    Keeps the landmarks of the faces in a stream of frames up to date.
+
+    Landmarks are detected on keyframes, every `keyframe_interval` frames,
+    and tracked with optical flow in between. A point is trusted when
+    tracking it forward and back again returns within `max_error` pixels
+    of where it started. If fewer than `min_tracked` of the points of a
+    face are trusted, the next frame is a keyframe. The remaining points
+    follow the similarity transform fitted to the trusted ones.
+    """
+
+    def __init__(self, detector, keyframe_interval=KEYFRAME_INTERVAL,
+                 min_tracked=MIN_TRACKED_FRACTION, max_error=MAX_FLOW_ERROR):
+        """ Initiator for LandmarkTracker class.
+        Args:
+            1. `detector`: DetectLandmarks (or ApplyMakeup) used on keyframes.
+            2. `keyframe_interval`: Number of frames between full detections.
+            3. `min_tracked`: Fraction of points of a face that must be tracked.
+            4. `max_error`: Forward-backward error, in pixels, of a tracked point.
+        """
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        self.min_tracked = min_tracked
+        self.max_error = max_error
+        self.reset()
+
+    def reset(self):
+        """ Forgets the tracked faces, so the next frame is a keyframe. """
+        self.landmarks = None
+        self.previous_gray = None
+        self.since_keyframe = 0
+        self.keyframe = True
+
+    def update(self, image):
+        """
+        Returns the landmarks of the faces in the next frame.
+        ___________________________________
+        Args:
+            1. `image`: RGB frame.
+
+        Returns:
+            Nx68x2 int32 array of the landmarks of every face, as returned by
+            get_face_data(..., all_faces=True), or `None` if no face is found.
+
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        self.keyframe = (
+            self.landmarks is None or self.since_keyframe >= self.keyframe_interval
+        )
+        if not self.keyframe:
+            self.landmarks = self.__track(gray)
+            self.keyframe = self.landmarks is None
+        if self.keyframe:
+            faces = self.detector.get_face_data(image, self.detector.IMAGE_DATA, all_faces=True)
+            self.landmarks = None if faces is None else faces.astype(np.float32)
+            self.since_keyframe = 0
+        self.since_keyframe += 1
+        self.previous_gray = gray
+        if self.landmarks is None:
+            return None
+        return np.round(self.landmarks).astype(np.int32)
+
+    def __track(self, gray):
+        """ Moves the landmarks from the previous frame onto gray.
+        Returns `None` if any face lost too many points.
+        """
+        previous = self.landmarks.reshape(-1, 1, 2)
+        flow = dict(winSize=FLOW_WINDOW, maxLevel=FLOW_LEVELS)
+        current, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, previous, None, **flow)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, current, None, **flow)
+        error = np.linalg.norm((back - previous).reshape(-1, 2), axis=1)
+        tracked = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self.max_error)
+
+        faces = current.reshape(-1, 68, 2)
+        tracked = tracked.reshape(-1, 68)
+        for face, previous_face, good in zip(faces, self.landmarks, tracked):
+            if good.mean() < self.min_tracked:
+                return None
+            if not good.all():
+                transform = cv2.estimateAffinePartial2D(previous_face[good], face[good])[0]
+                if transform is None:
+                    return None
+                face[~good] = cv2.transform(previous_face[~good].reshape(-1, 1, 2), transform).reshape(-1, 2)
+        return faces
+
+
+class OneEuroFilter(object):
+    """
+    One-Euro filter of landmark positions.
+
+    A low-pass filter whose cutoff frequency rises with the speed of the
+    points: at rest, `min_cutoff` (Hz) removes the jitter of the detector,
+    and fast motion raises the cutoff by `beta` per pixel/second, so the
+    makeup does not lag behind the face.
+    """
+
+    def __init__(self, min_cutoff=SMOOTHING_MIN_CUTOFF, beta=SMOOTHING_BETA, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        """ Forgets the filtered points. """
+        self.value = None
+        self.speed = None
+
+    @staticmethod
+    def __alpha(cutoff, dt):
+        """ Returns the smoothing factor of a low-pass filter. """
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def __call__(self, points, dt):
+        """ Returns the filtered points, `dt` seconds after the previous ones.
+        The filter restarts when the number of points changes.
+        """
+        points = np.asarray(points, dtype=np.float32)
+        if self.value is None or self.value.shape != points.shape:
+            self.value = points.copy()
+            self.speed = np.zeros_like(points)
+            return self.value.copy()
+        speed = (points - self.value) / dt
+        self.speed += self.__alpha(self.d_cutoff, dt) * (speed - self.speed)
+        # Cutoff per point, from the speed of the point.
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(self.speed, axis=-1, keepdims=True)
+        self.value += self.__alpha(cutoff, dt) * (points - self.value)
+        return self.value.copy()
+
+
+class VideoMakeup(object):
+    """
+    Renders a makeup look on a stream of video frames.
+
+    Functions available for use:
+        1. render_frame: Applies the look on one BGR frame.
+        2. stream: Yields rendered frames of a video file or camera.
+        3. render_video: Writes the rendered frames of a video to a file or window.
+    """
+
+    def __init__(self, makeup=None, lipstick=None, liner=False, blush=None, eyeshadow=None,
+                 smoothing=True, reuse_masks=True, fps=DEFAULT_FPS, **tracker_kwargs):
+        """ Initiator for VideoMakeup class.
+        Args:
+            1. `makeup`: ApplyMakeup used for detection and rendering. A new one by default.
+            2. `lipstick`, `liner`, `blush`, `eyeshadow`: Look, as for ApplyMakeup.render().
+            3. `smoothing`: Filter the landmarks over time. `True`, `False` or a OneEuroFilter.
+            4. `reuse_masks`: Reuse and warp the feather masks of earlier frames.
+            5. `fps`: Frame rate of the frames given to render_frame(). stream() reads it from the video.
+            6. `tracker_kwargs`: Keyword arguments of LandmarkTracker.
+        """
+        self.makeup = makeup if makeup is not None else ApplyMakeup()
+        self.look = dict(lipstick=lipstick, liner=liner, blush=blush, eyeshadow=eyeshadow)
+        self.tracker = LandmarkTracker(self.makeup, **tracker_kwargs)
+        if smoothing is True:
+            smoothing = OneEuroFilter()
+        self.smoothing = smoothing or None
+        self.masks = MaskCache() if reuse_masks else None
+        self.fps = fps
+
+    def reset(self):
+        """ Forgets the tracked faces, filtered landmarks and stored masks. """
+        self.tracker.reset()
+        if self.smoothing is not None:
+            self.smoothing.reset()
+        if self.masks is not None:
+            self.masks.clear()
+
+    def render_frame(self, frame):
+        """ Returns the BGR frame with the look applied on every tracked face. """
+        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        landmarks = self.tracker.update(image)
+        if landmarks is None:
+            # A face that shows up again later must not slide in from here.
+            if self.smoothing is not None:
+                self.smoothing.reset()
+            return frame
+        if self.smoothing is not None:
+            if self.tracker.keyframe and self.smoothing.value is not None:
+                # Detection may list the faces in another order than before.
+                order = match_faces(self.smoothing.value, self.tracker.landmarks)
+                if order is None:
+                    self.smoothing.reset()
+                else:
+                    self.tracker.landmarks = self.tracker.landmarks[order]
+            landmarks = np.round(self.smoothing(self.tracker.landmarks, 1.0 / self.fps)).astype(np.int32)
+        result = self.makeup.render(image, landmarks, masks=self.masks, **self.look)
+        return cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+
+    def stream(self, source):
+        """
+        Yields rendered frames of a video.
+        ___________________________________
+        Args:
+            1. `source`: Video file path, camera index, or an opened cv2.VideoCapture.
+
+        Yields:
+            Rendered BGR frames, in order.
+
+        """
+        capture = source if isinstance(source, cv2.VideoCapture) else cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise IOError('Could not open video source %r' % (source,))
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or self.fps
+        self.reset()
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield self.render_frame(frame)
+        finally:
+            if capture is not source:
+                capture.release()
+
+    def render_video(self, source, output_path=None, show=False, fourcc='mp4v'):
+        """
+        Renders a whole video.
+        ___________________________________
+        Args:
+            1. `source`: Video file path, camera index, or an opened cv2.VideoCapture.
+            2. `output_path (str)`: Video file the rendered frames are written to, or `None`.
+            3. `show (bool)`: Show the rendered frames in a window. Esc or q stops.
+            4. `fourcc (str)`: Codec of output_path.
+
+        Returns:
+            Number of rendered frames.
+
+        """
+        capture = source if isinstance(source, cv2.VideoCapture) else cv2.VideoCapture(source)
+        fps = capture.get(cv2.CAP_PROP_FPS) or self.fps
+        writer = None
+        count = 0
+        try:
+            for frame in self.stream(capture):
+                count += 1
+                if output_path:
+                    if writer is None:
+                        height, width = frame.shape[:2]
+                        writer = cv2.VideoWriter(
+                            output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height)
+                        )
+                    writer.write(frame)
+                if show:
+                    cv2.imshow('visage', frame)
+                    if cv2.waitKey(1) & 0xff in (27, ord('q')):
+                        break
+        finally:
+            if writer is not None:
+                writer.release()
+            if capture is not source:
+                capture.release()
+            if show:
+                cv2.destroyAllWindows()
+        return count
+
+
+def main(argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(
+        prog='visage-video', description='Apply virtual makeup to a video or camera stream.'
+    )
+    parser.add_argument('source', help='video file, or camera index such as 0')
+    parser.add_argument('-o', '--output', help='video file for the rendered frames')
+    parser.add_argument('--show', action='store_true', help='show the rendered frames in a window')
+    parser.add_argument('--keyframe-interval', type=int, default=KEYFRAME_INTERVAL,
+                        help='frames between full face detections')
+    parser.add_argument('--no-smoothing', action='store_true', help='do not filter the landmarks over time')
+    parser.add_argument('--lipstick', type=parse_color, help='lipstick colour, e.g. 170,10,30')
+    parser.add_argument('--liner', action='store_true', help='apply eyeliner')
+    parser.add_argument('--blush', type=parse_color, help='blush colour')
+    parser.add_argument('--eyeshadow', type=parse_color, help='eyeshadow colour')
+    args = parser.parse_args(argv)
+    if not args.output and not args.show:
+        parser.error('nothing to do, pass --output and/or --show')
+
+    video = VideoMakeup(
+        lipstick=args.lipstick, liner=args.liner, blush=args.blush, eyeshadow=args.eyeshadow,
+        smoothing=not args.no_smoothing, keyframe_interval=args.keyframe_interval
+    )
+    source = int(args.source) if args.source.isdigit() else args.source
+    video.render_video(source, args.output, args.show)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())